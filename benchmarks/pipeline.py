@@ -0,0 +1,309 @@
+# end to end benchmark of a headless build, to see how much of it is the script and not revanced-cli.
+# java and keytool are replaced by the stubs in stubs/ (canned output, configurable patch count and
+# delays), github and the apk sites by the stand-in server. every run is a fresh python process so
+# peak memory is per run. the stand-in server and its downloads get a process of their own, linux
+# counts the memory of the parent at the time of the fork towards the peak of the child.
+# a cold run starts without caches and a warm run repeats it with --force
+#
+#   python benchmarks/pipeline.py [--patches 10 200 2000] [--repeat 3] [--patch-delay 1] [--json results.json]
+import argparse
+import json
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from standin import StandIn
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCHMARKS)
+STUBS = os.path.join(BENCHMARKS, "stubs")
+YOUTUBE = "com.google.android.youtube"
+
+# phase name and what it's measured around: a function of revanced or a (class, method name) pair
+PHASES = [
+    ("java probe", "java_info"),
+    ("keystore check", "check_keystore_type"),
+    ("github releases", "get_github_releases"),
+    ("tool downloads", "fetch_release_asset"),
+    ("list patches", "list_patches"),
+    ("catalog parsing", ("PatchCatalog", "parse")),
+    ("list versions", "list_versions"),
+    ("apk sources", "race_apk_sources"),
+    ("apk download", "fetch_apk"),
+    ("selection", ("Selection", "flags")),
+    ("build inputs", "build_inputs"),
+    ("temporary files", "acquire_temporary_files"),
+]
+
+
+def instrument(revanced, timings: dict):
+    # every call adds its duration to its phase, calls on other threads are counted too
+    lock = threading.Lock()
+
+    def timed(phase, function):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                name = phase(args) if callable(phase) else phase
+                with lock:
+                    calls, seconds = timings.get(name, (0, 0))
+                    timings[name] = (calls + 1, seconds + time.perf_counter() - start)
+
+        return wrapper
+
+    for phase, target in PHASES:
+        if isinstance(target, tuple):
+            cls, method = getattr(revanced, target[0]), target[1]
+            function = cls.__dict__[method]
+            if isinstance(function, classmethod):
+                setattr(cls, method, classmethod(timed(phase, function.__func__)))
+            else:
+                setattr(cls, method, timed(phase, function))
+        else:
+            setattr(revanced, target, timed(phase, getattr(revanced, target)))
+    # subprocesses of the cli by their command, these are the stubs' share of the run
+    revanced.run_cli = timed(
+        lambda args: "cli "
+        + " ".join(
+            x for x in args[0] if x in ("patch", "--help") or x.startswith("list-")
+        ),
+        revanced.run_cli,
+    )
+
+
+def run(config: dict):
+    # runs in the child process, in the folder of the build
+    os.chdir(config["work_dir"])
+    sys.path.insert(0, ROOT)
+    import revanced
+
+    revanced.SESSION = revanced.HttpSession(handlers=[StandIn(config["server"])])
+    timings = {}
+    instrument(revanced, timings)
+
+    sys.argv = [
+        "revanced.py",
+        "--headless",
+        "--app",
+        YOUTUBE,
+        # the = form, selections can start with -
+        "--select=" + config["select"],
+        *(["--force"] if config["warm"] else []),
+    ]
+    error = None
+    start = time.perf_counter()
+    try:
+        revanced.main()
+    except SystemExit as e:
+        if e.code:
+            error = str(e.code)
+    wall = time.perf_counter() - start
+    with open(config["results"], "w") as file:
+        json.dump(
+            {
+                "wall": wall,
+                "phases": timings,
+                # kilobytes on linux
+                "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                "error": error,
+            },
+            file,
+        )
+
+
+def run_child(config: dict, args) -> dict:
+    environment = dict(os.environ)
+    for name in ["GITHUB_TOKEN", "GH_TOKEN"]:
+        environment.pop(name, None)
+    environment.update(
+        {
+            "PATH": STUBS + os.pathsep + environment.get("PATH", ""),
+            "REVANCED_STUB_PATCHES": str(config["patches"]),
+            "REVANCED_STUB_STARTUP": str(args.startup),
+            "REVANCED_STUB_LIST_DELAY": str(args.list_delay),
+            "REVANCED_STUB_PATCH_DELAY": str(args.patch_delay),
+        }
+    )
+    config["results"] = os.path.join(config["work_dir"], "results.json")
+    with open(os.path.join(config["work_dir"], "output.log"), "a") as log:
+        process = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--run", json.dumps(config)],
+            env=environment,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
+    if process.returncode != 0 or not os.path.exists(config["results"]):
+        return {"error": "crashed, see %s" % log.name}
+    with open(config["results"]) as file:
+        result = json.load(file)
+    os.remove(config["results"])
+    if result["error"]:
+        result["error"] += ", see %s" % log.name
+    return result
+
+
+def summarize(name: str, runs: list) -> dict:
+    phases = {}
+    for run in runs:
+        for phase, (calls, seconds) in run["phases"].items():
+            phases.setdefault(phase, []).append(seconds)
+    wall = statistics.median(run["wall"] for run in runs)
+    cli = sum(
+        statistics.median(times)
+        for phase, times in phases.items()
+        if phase.startswith("cli ")
+    )
+    return {
+        "name": name,
+        "runs": len(runs),
+        "wall": wall,
+        # what's left after taking out the cli: the script itself, and the stand-in server's answers.
+        # list-versions runs next to other work, so this is a lower bound
+        "outside cli": wall - cli,
+        "phases": {phase: statistics.median(times) for phase, times in phases.items()},
+        "peak_rss": max(run["peak_rss"] for run in runs),
+    }
+
+
+def print_table(results: list):
+    sys.path.insert(0, ROOT)
+    from revanced import format_size
+
+    phases = [phase for phase, _ in PHASES]
+    phases += sorted(
+        {phase for result in results for phase in result["phases"]} - set(phases)
+    )
+    width = max(12, *(len(result["name"]) for result in results))
+    print(
+        "%-18s" % "phase"
+        + "".join(" %*s" % (width, result["name"]) for result in results)
+    )
+    for phase in ["wall", "outside cli"] + phases:
+        cells = [
+            result[phase] if phase in result else result["phases"].get(phase)
+            for result in results
+        ]
+        print(
+            "%-18s" % phase
+            + "".join(
+                " %*s" % (width, "-" if cell is None else "%.1fms" % (cell * 1000))
+                for cell in cells
+            )
+        )
+    print(
+        "%-18s" % "peak rss"
+        + "".join(
+            " %*s" % (width, format_size(result["peak_rss"])) for result in results
+        )
+    )
+
+
+def run_all(args, address: str) -> tuple:
+    results = []
+    failed = False
+    for patches in args.patches:
+        runs = {"cold": [], "warm": []}
+        for _ in range(args.repeat):
+            work_dir = tempfile.mkdtemp(prefix="revanced-pipeline-")
+            for kind in ["cold", "warm"]:
+                config = {
+                    "work_dir": work_dir,
+                    "patches": patches,
+                    "select": args.select,
+                    "server": address,
+                    "warm": kind == "warm",
+                }
+                result = run_child(config, args)
+                if result["error"]:
+                    print("%d patches %s: %s" % (patches, kind, result["error"]))
+                    failed = True
+                    break
+                runs[kind].append(result)
+            if not args.keep and not failed:
+                shutil.rmtree(work_dir)
+        for kind, kind_runs in runs.items():
+            if kind_runs:
+                results.append(summarize("%d %s" % (patches, kind), kind_runs))
+    return results, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="benchmark headless builds with stubbed java, keytool and network"
+    )
+    parser.add_argument("--run", help=argparse.SUPPRESS)
+    parser.add_argument(
+        "--patches",
+        type=int,
+        nargs="+",
+        default=[10, 200, 2000],
+        help="patch counts of the stub bundle",
+    )
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    parser.add_argument(
+        "--select",
+        default="-spoof*,+/^hide /",
+        help="patch selection passed to --select",
+    )
+    parser.add_argument(
+        "--startup", type=float, default=0, help="seconds every stub java call takes"
+    )
+    parser.add_argument(
+        "--list-delay",
+        type=float,
+        default=0,
+        help="extra seconds for list-patches and list-versions",
+    )
+    parser.add_argument(
+        "--patch-delay", type=float, default=0, help="extra seconds for patch"
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0,
+        help="milliseconds the stand-in server waits before every response",
+    )
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument(
+        "--keep", action="store_true", help="keep the build folders and their logs"
+    )
+    args = parser.parse_args()
+    if args.run:
+        return run(json.loads(args.run))
+
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(BENCHMARKS, "standin.py"),
+            "--latency",
+            str(args.latency),
+        ],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    address = server.stdout.readline().strip()
+    try:
+        results, failed = run_all(args, address)
+    finally:
+        server.terminate()
+
+    if results:
+        print_table(results)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=1)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+# offline benchmarks and regression checks for the apk scrapers, github releases and downloads.
+# everything runs against the stand-in server with recorded responses (see standin.py), a run that
+# doesn't come up with the expected result fails, so regex regressions show up here and not in builds
+#
+#   python benchmarks/scrapers.py [--repeat 5] [--latency 50] [--json results.json] [scenario ...]
+import argparse
+import contextlib
+import hashlib
+import importlib
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from standin import StandIn, StandInServer, load_routes
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+YOUTUBE = "com.google.android.youtube"
+CLI_URL = "https://github.com/ReVanced/revanced-cli/releases/download/v5.0.1/revanced-cli-5.0.1-all.jar"
+revanced = None
+
+
+def download(connections: int) -> str:
+    name = os.path.join(revanced.CACHE_DIR, "revanced-cli.jar")
+    return revanced.download_file(CLI_URL, name, connections, False, zip_file=True)
+
+
+def apkmirror_warm() -> str:
+    # download urls expire long before the pages they come from, the run after that starts from the
+    # cached variant page instead of returning the cached url without a request
+    revanced.SCRAPE_CACHE.invalidate("apkmirror:download:", YOUTUBE)
+    return revanced.apkmirror(YOUTUBE, "19.16.39")
+
+
+def expected_digest(routes: dict) -> str:
+    redirect = routes[CLI_URL]["headers"]["Location"]
+    return hashlib.sha256(routes[redirect]["body"]).hexdigest()
+
+
+# name, warm, function, expected result. warm scenarios run once untimed first, so they measure
+# what the caches (scrape cache, github etags, open connections) save on the next run
+SCENARIOS = [
+    (
+        "apkmirror",
+        False,
+        lambda: revanced.apkmirror(YOUTUBE, "19.16.39"),
+        "https://downloadr2.apkmirror.com/wp-content/uploads/2024/04/67/66202d3e2a0a3/com.google.android.youtube_19.16.39-1545994176_minAPI26_nodpi_apkmirror.com.apk?verify=1713312000-Xq1c0Zb9qG5mW3fJ2yN8pL4vR7tK6hD0sA1eU9oI2wE",
+    ),
+    (
+        "apkmirror warm",
+        True,
+        apkmirror_warm,
+        "https://downloadr2.apkmirror.com/wp-content/uploads/2024/04/67/66202d3e2a0a3/com.google.android.youtube_19.16.39-1545994176_minAPI26_nodpi_apkmirror.com.apk?verify=1713312000-Xq1c0Zb9qG5mW3fJ2yN8pL4vR7tK6hD0sA1eU9oI2wE",
+    ),
+    (
+        "apkcombo",
+        False,
+        lambda: revanced.apkcombo(YOUTUBE, "19.16.39"),
+        "https://download.apkcombo.com/com.google.android.youtube/YouTube_19.16.39_apkcombo.com.apk?ecp=Y29tLmdvb2dsZS5hbmRyb2lkLnlvdXR1YmUvMTkuMTYuMzkvMTU0NTk5NDE3Ni5hcGs=&iat=1713312000&sig=0c3a2d1e5f4b6a7988776655443322110&size=131564206&from=cf&lang=en&fp=3f2c9a0e5b7d41e8a6c3b2d1f0e9a8c7&ip=203.0.113.7",
+    ),
+    (
+        # external download links only match apkcombo's second regex
+        "apkcombo r2 link",
+        False,
+        lambda: revanced.apkcombo("com.zhiliaoapp.musically", "34.1.2"),
+        "https://apkcombo.com/r2?u=https%3A%2F%2Fpackages.example.net%2Ftiktok%2FTikTok_34.1.2.apk&sig=d41d8cd98f00b204&fp=3f2c9a0e5b7d41e8a6c3b2d1f0e9a8c7&ip=203.0.113.7",
+    ),
+    (
+        "apkpure",
+        False,
+        lambda: revanced.apkpure(YOUTUBE, "19.16.39"),
+        "https://download.pureapk.com/b/APK/Y29tLmdvb2dsZS5hbmRyb2lkLnlvdXR1YmVfMTU0NTk5NDE3Nl8xYjI0YjQ2?_fn=WW91VHViZV92MTkuMTYuMzlfYXBrcHVyZS5jb20uYXBr&as=3c5d0c2a9f1b8e7d6c5b4a3928171605&ai=-1412573044&at=1713312000&_sa=ai%2Cat&k=2b8e0a7c6d5f4e3a2b1c0d9e8f7a6b5c&_p=Y29tLmdvb2dsZS5hbmRyb2lkLnlvdXR1YmU&c=1%7CVIDEO_PLAYERS%7CZGV2PUdvb2dsZSUyMExMQyZ2bj0xOS4xNi4zOSZ2Yz0xNTQ1OTk0MTc2",
+    ),
+    (
+        "github latest",
+        False,
+        lambda: revanced.get_github_releases(get=["cli"], latest=True)["cli"][0][
+            "tag_name"
+        ],
+        "v5.0.1",
+    ),
+    (
+        # answered with 304 not modified
+        "github latest warm",
+        True,
+        lambda: revanced.get_github_releases(get=["cli"], latest=True)["cli"][0][
+            "tag_name"
+        ],
+        "v5.0.1",
+    ),
+    (
+        # two pages linked with the Link header
+        "github all releases",
+        False,
+        lambda: len(revanced.get_github_releases(get=["patches"], amount=0)["patches"]),
+        50,
+    ),
+    ("download", False, lambda: download(1), "digest"),
+    ("download 4 connections", False, lambda: download(4), "digest"),
+]
+
+
+def fresh_state(server: StandInServer, work_dir: str):
+    # empty caches and no open connections, like the first run on a new machine
+    revanced.CACHE_DIR = tempfile.mkdtemp(dir=work_dir)
+    revanced.SCRAPE_CACHE = revanced.ScrapeCache(
+        os.path.join(revanced.CACHE_DIR, "scrape.json")
+    )
+    revanced.DIGESTS_FILE = os.path.join(revanced.CACHE_DIR, "digests.json")
+    revanced.SESSION = revanced.HttpSession(handlers=[StandIn(server.address)])
+
+
+def call(function) -> tuple:
+    try:
+        return function(), None
+    except Exception as e:
+        return None, "%s: %s" % (type(e).__name__, e)
+
+
+def run_scenario(server, work_dir, function, warm, expected) -> dict:
+    fresh_state(server, work_dir)
+    output = io.StringIO()
+    result = error = None
+    with contextlib.redirect_stdout(output):
+        if warm:
+            result, error = call(function)
+        server.reset()
+        start = time.perf_counter()
+        if error is None:
+            result, error = call(function)
+        seconds = time.perf_counter() - start
+    if error is None and result != expected:
+        error = "expected %r, got %r" % (expected, result)
+    if server.unmatched:
+        error = (error + ", " if error else "") + "no recorded response for %s" % (
+            ", ".join(server.unmatched)
+        )
+    return {
+        "seconds": seconds,
+        "requests": sum(server.requests.values()),
+        "bytes": server.bytes,
+        "error": error,
+        "output": output.getvalue(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="benchmark the scrapers, github requests and downloads against recorded responses"
+    )
+    parser.add_argument(
+        "scenarios", nargs="*", help="only run the scenarios with these names"
+    )
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0,
+        help="milliseconds the stand-in waits before every response",
+    )
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+    if args.json:
+        args.json = os.path.abspath(args.json)
+
+    # revanced keeps its caches next to where it's started and reads github tokens, neither should
+    # come from or end up in the real working directory
+    work_dir = tempfile.mkdtemp(prefix="revanced-benchmark-")
+    os.chdir(work_dir)
+    for name in ["GITHUB_TOKEN", "GH_TOKEN"]:
+        os.environ.pop(name, None)
+    sys.path.insert(0, ROOT)
+    global revanced
+    revanced = importlib.import_module("revanced")
+    # the recorded release page has more than one variant that fits
+    revanced.ANSWERS["variant"] = "nodpi"
+
+    routes = load_routes()
+    server = StandInServer(routes, args.latency / 1000).start()
+    digest = expected_digest(routes)
+
+    unknown = set(args.scenarios) - {name for name, *_ in SCENARIOS}
+    if unknown:
+        sys.exit("unknown scenarios: %s" % ", ".join(sorted(unknown)))
+
+    results = []
+    print(
+        "%-24s %9s %9s %9s %11s  %s"
+        % ("scenario", "median", "min", "requests", "bytes", "check")
+    )
+    for name, warm, function, expected in SCENARIOS:
+        if args.scenarios and name not in args.scenarios:
+            continue
+        expected = digest if expected == "digest" else expected
+        runs = [
+            run_scenario(server, work_dir, function, warm, expected)
+            for _ in range(args.repeat)
+        ]
+        errors = [run for run in runs if run["error"]]
+        times = [run["seconds"] for run in runs]
+        entry = {
+            "name": name,
+            "runs": len(runs),
+            "median": statistics.median(times),
+            "min": min(times),
+            "requests": runs[-1]["requests"],
+            "bytes": runs[-1]["bytes"],
+            "error": errors[0]["error"] if errors else None,
+        }
+        results.append(entry)
+        print(
+            "%-24s %8.1fms %8.1fms %9d %11s  %s"
+            % (
+                name,
+                entry["median"] * 1000,
+                entry["min"] * 1000,
+                entry["requests"],
+                revanced.format_size(entry["bytes"]),
+                "FAIL " + entry["error"] if errors else "ok",
+            )
+        )
+        if errors:
+            print(errors[0]["output"], end="")
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=1)
+    server.shutdown()
+    if any(entry["error"] for entry in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+# a local http server that stands in for github and the apk sites, it answers with the responses
+# recorded in fixtures/routes.json so the scrapers and downloads can be measured without the network
+import argparse
+import functools
+import http.server
+import io
+import json
+import os
+import random
+import threading
+import time
+import urllib.parse
+import urllib.request
+import zipfile
+from collections import Counter
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+@functools.lru_cache(maxsize=None)
+def generated_zip(size: int, seed: int) -> bytes:
+    # downloads aren't recorded, a stored zip with random content of the same size is just as slow to
+    # send and passes the zip checks. fixed seed and timestamp, the digest is the same every run.
+    # routes with the same size and seed share one body
+    entry = zipfile.ZipInfo("classes.dex", date_time=(2024, 1, 1, 0, 0, 0))
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+        archive.writestr(entry, random.Random(seed).randbytes(size))
+    return buffer.getvalue()
+
+
+def load_routes(path: str = os.path.join(FIXTURES, "routes.json")) -> dict:
+    # url -> {status, headers, body}, bodies come from a fixture file, inline text or are generated
+    with open(path) as file:
+        routes = json.load(file)
+    for url, route in routes.items():
+        headers = dict(route.get("headers", {}))
+        body = b""
+        if "file" in route:
+            with open(os.path.join(FIXTURES, route["file"]), "rb") as file:
+                body = file.read()
+            headers.setdefault(
+                "Content-Type",
+                (
+                    "application/json; charset=utf-8"
+                    if route["file"].endswith(".json")
+                    else "text/html; charset=UTF-8"
+                ),
+            )
+        elif "text" in route:
+            body = route["text"].encode()
+        elif "generate" in route:
+            body = generated_zip(route["generate"], route.get("seed", 0))
+            headers["Accept-Ranges"] = "bytes"
+        if "content_type" in route:
+            headers["Content-Type"] = route["content_type"]
+        if "location" in route:
+            headers["Location"] = route["location"]
+        if "etag" in route:
+            headers["ETag"] = route["etag"]
+        headers.setdefault("Content-Type", "text/html; charset=UTF-8")
+        routes[url] = {
+            "status": route.get("status", 200),
+            "headers": headers,
+            "body": body,
+        }
+    return routes
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are separate writes, with nagle every response would wait for a delayed ack
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        # the first path segment is the host the request was meant for, see StandIn
+        host, _, rest = self.path[1:].partition("/")
+        url = "https://%s/%s" % (host, rest)
+        route = server.routes.get(url)
+        if server.latency:
+            time.sleep(server.latency)
+        if route is None:
+            server.count(host, url)
+            return self.respond(404, {"Content-Type": "text/plain"}, b"not recorded")
+        server.count(host)
+
+        status, headers, body = route["status"], dict(route["headers"]), route["body"]
+        etag = headers.get("ETag")
+        if etag and self.headers.get("If-None-Match") == etag:
+            status, body = 304, b""
+        elif self.headers.get("Range") and headers.get("Accept-Ranges") == "bytes":
+            if_range = self.headers.get("If-Range")
+            if not if_range or if_range == etag:
+                start, _, end = self.headers["Range"][len("bytes=") :].partition("-")
+                start, end = int(start), int(end) if end else len(body) - 1
+                headers["Content-Range"] = "bytes %d-%d/%d" % (start, end, len(body))
+                status, body = 206, body[start : end + 1]
+        self.respond(status, headers, body, count=True)
+
+    def respond(self, status: int, headers: dict, body: bytes, count: bool = False):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            # in pieces so a client that hangs up early (like a ranged download) isn't counted for
+            # the whole body. counted before sending, the client can't be done before the counter is
+            for start in range(0, len(body), 64 * 1024):
+                chunk = body[start : start + 64 * 1024]
+                if count:
+                    self.server.count_bytes(len(chunk))
+                self.wfile.write(chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+
+class StandInServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, routes: dict, latency: float = 0):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.routes = routes
+        # seconds before every response, roughly a round trip to a real server
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.reset()
+
+    @property
+    def address(self) -> str:
+        return "%s:%d" % self.server_address
+
+    def count(self, host: str, unmatched: str = None):
+        with self.lock:
+            self.requests[host] += 1
+            if unmatched:
+                self.unmatched.append(unmatched)
+
+    def count_bytes(self, sent: int):
+        with self.lock:
+            self.bytes += sent
+
+    def reset(self):
+        with self.lock:
+            self.requests = Counter()
+            self.bytes = 0
+            self.unmatched = []
+
+    def start(self) -> "StandInServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class StandIn(urllib.request.BaseHandler):
+    # sends requests to the stand-in server instead, the original host becomes the first path segment.
+    # runs before the keep alive handler opens a connection, redirects pass through here again
+    handler_order = 100
+
+    def __init__(self, address: str):
+        self.address = address
+
+    def http_request(self, request):
+        url = urllib.parse.urlsplit(request.full_url)
+        if url.netloc != self.address:
+            request.full_url = "http://%s/%s%s%s" % (
+                self.address,
+                url.netloc,
+                url.path,
+                "?" + url.query if url.query else "",
+            )
+        return request
+
+    https_request = http_request
+
+
+def main():
+    # serves until it's killed, for benchmarks that need the stand-in in a process of its own
+    parser = argparse.ArgumentParser(
+        description="serve the recorded responses, prints the address first"
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0,
+        help="milliseconds to wait before every response",
+    )
+    args = parser.parse_args()
+    server = StandInServer(load_routes(), args.latency / 1000)
+    print(server.address, flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -7,29 +7,251 @@ import time
 import re
 import sys
 import traceback
-from random import shuffle
+import hashlib
+import struct
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
 from math import ceil
 import urllib.request
-from urllib.request import Request, urlopen, build_opener, HTTPRedirectHandler
+import urllib.parse
+import http.client
+import http.cookiejar
+import ssl
+import socket
+import signal
+import functools
+import html
+import fnmatch
+from urllib.request import Request, build_opener, HTTPRedirectHandler
 from urllib.error import URLError, HTTPError
 
+try:
+    import tomllib
+except ImportError:
+    # python < 3.11, batch manifests have to be json there
+    tomllib = None
+
 
 USER_AGENT = (
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:135.0) Gecko/20100101 Firefox/135.0"
 )
 p = print
+# shared between all repository folders, relative to where the script is started like _builds
+CACHE_DIR = os.path.abspath("_cache")
+
+
+# per thread state of work that runs in the background, like the apk source race
+CURRENT_TASK = threading.local()
+
+
+class SelectionRequired(Exception):
+    # raised instead of prompting when the current thread isn't allowed to wait for user input
+    def __init__(self, message: str, item_list: list):
+        super().__init__("selection required: %s" % message.strip())
+        self.item_list = item_list
+
+
+class Cancelled(Exception):
+    pass
+
+
+# timings of a run for --trace, written as chrome trace events (open the file in chrome://tracing or
+# ui.perfetto.dev) with a summary at the end. spans on one thread nest, nothing is recorded without --trace
+TRACE = None
+
+
+class Trace:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.events = []
+        self.threads = set()
+
+    def add(self, span: "Span", end: float):
+        thread = threading.current_thread()
+        event = {
+            "name": span.name,
+            "cat": span.category,
+            "ph": "X",
+            # microseconds since the start of the run
+            "ts": round((span.start - self.start) * 1e6, 1),
+            "dur": round((end - span.start) * 1e6, 1),
+            "pid": os.getpid(),
+            "tid": thread.ident,
+            "args": span.args,
+        }
+        with self.lock:
+            if thread.ident not in self.threads:
+                # task threads show up with their names instead of just an id
+                self.threads.add(thread.ident)
+                self.events.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": os.getpid(),
+                        "tid": thread.ident,
+                        "args": {"name": thread.name},
+                    }
+                )
+            self.events.append(event)
+
+    def write(self, path: str):
+        with self.lock:
+            events = list(self.events)
+        write_json(path, {"traceEvents": events, "displayTimeUnit": "ms"})
+
+    def summary(self) -> str:
+        # calls, total and longest time per span. a span inside another one counts for both, and spans of
+        # tasks that ran at the same time add up to more than the wall time
+        totals = {}
+        with self.lock:
+            for event in self.events:
+                if event["ph"] != "X":
+                    continue
+                key = (event["cat"], event["name"])
+                calls, total, longest = totals.get(key, (0, 0, 0))
+                totals[key] = (
+                    calls + 1,
+                    total + event["dur"],
+                    max(longest, event["dur"]),
+                )
+        lines = ["%-10s %-30s %6s %9s %9s" % ("", "span", "calls", "total", "longest")]
+        for (category, name), (calls, total, longest) in sorted(
+            totals.items(), key=lambda x: -x[1][1]
+        ):
+            lines.append(
+                "%-10s %-30s %6d %8.2fs %8.2fs"
+                % (category, name[:30], calls, total / 1e6, longest / 1e6)
+            )
+        lines.append(
+            "%-10s %-30s %6s %8.2fs"
+            % ("", "wall", "", time.perf_counter() - self.start)
+        )
+        return "\n".join(lines)
+
+
+class Span:
+    # with Span("list patches"): times the block when tracing. keyword arguments end up in the trace event,
+    # more can be added to .args inside the block
+    def __init__(self, name: str, category: str = "phase", **args):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if TRACE is not None:
+            if exc_type is not None:
+                self.args["error"] = exc_type.__name__
+            TRACE.add(self, time.perf_counter())
+
+
+def traced(name: str, category: str, describe=None):
+    # a span around every call of the decorated function, describe gets the same arguments and
+    # returns the args of the span
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if TRACE is None:
+                return function(*args, **kwargs)
+            with Span(
+                name, category, **(describe(*args, **kwargs) if describe else {})
+            ):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def write_trace(path: str):
+    TRACE.write(path)
+    print(TRACE.summary())
+    print("Trace written to", path)
+
+
+# answers to the questions the script would otherwise ask, from flags or a profile file (see main).
+# in headless mode nothing waits for input, a question without a usable answer ends the run instead
+ANSWERS = {}
+HEADLESS = False
+PROFILE_KEYS = [
+    "app",
+    "version",
+    "select",
+    "cli_release",
+    "patches_release",
+    "apkmirror_app",
+    "variant",
+    "apk",
+]
+
+
+def current_answers() -> dict:
+    # batch builds bring answers of their own for the thread they run on, see run_batch_build
+    answers = getattr(CURRENT_TASK, "answers", None)
+    return ANSWERS if answers is None else answers
+
+
+def answered_item(answer_key: str, item_list: list, printable_item_list: list):
+    # the item the answer stands for: the one printed exactly like it or the only one containing it.
+    # None means the user can be asked
+    answer = current_answers().get(answer_key) if answer_key else None
+    batch = getattr(CURRENT_TASK, "answers", None) is not None
+    flag = (
+        (answer_key if batch else "--" + answer_key.replace("_", "-"))
+        if answer_key
+        else "an answer"
+    )
+    if answer is None:
+        if not HEADLESS and not batch:
+            return None
+        if len(item_list) == 1:
+            return item_list[0]
+        raise SelectionRequired(
+            "%s is needed to choose from %s" % (flag, ", ".join(printable_item_list)),
+            item_list,
+        )
+    matches = [
+        item for item, text in zip(item_list, printable_item_list) if text == answer
+    ] or [
+        item
+        for item, text in zip(item_list, printable_item_list)
+        if answer.lower() in text.lower()
+    ]
+    if len(matches) != 1:
+        raise SelectionRequired(
+            "%s %s matches %d of %s"
+            % (flag, answer, len(matches), ", ".join(printable_item_list)),
+            item_list,
+        )
+    return matches[0]
 
 
 def select_one_item(
-    message: str, item_list: list, map_function=None, allow_empty: bool = False
+    message: str,
+    item_list: list,
+    map_function=None,
+    allow_empty: bool = False,
+    answer_key: str = None,
 ):
     printable_item_list = list(map(map_function, item_list)) if map_function else None
+    answers = printable_item_list or list(map(str, item_list))
+    item = answered_item(answer_key, item_list, answers)
+    if item is not None:
+        print(message + answers[item_list.index(item)])
+        return item
+    if getattr(CURRENT_TASK, "defer_prompts", False):
+        raise SelectionRequired(message, item_list)
     longest_line = 0
     for index, item in enumerate(printable_item_list or item_list, start=1):
         s = f"{index:{len(str(len(item_list)))}}. {item}"
         if len(s) > longest_line:
             longest_line = len(s)
-    print(("-" * longest_line)[0 : os.get_terminal_size().columns - 1])
+    print(("-" * longest_line)[0 : shutil.get_terminal_size().columns - 1])
     for index, item in enumerate(printable_item_list or item_list, start=1):
         print(f"{index:{len(str(len(item_list)))}}. {item}")
 
@@ -40,6 +262,9 @@ def select_one_item(
                 return None
             choice = int(choice)
             if 1 <= choice <= len(item_list):
+                if answer_key:
+                    # remembered for --save-profile
+                    ANSWERS[answer_key] = answers[choice - 1]
                 return item_list[choice - 1]
             else:
                 print("Please enter a valid number corresponding to the options.")
@@ -54,13 +279,15 @@ def select_multiple_items(
     allow_empty: bool = False,
     custom_input_parser=None,
 ):
+    if getattr(CURRENT_TASK, "defer_prompts", False) or HEADLESS:
+        raise SelectionRequired(message, item_list)
     printable_item_list = list(map(map_function, item_list)) if map_function else None
     longest_line = 0
     for index, item in enumerate(printable_item_list or item_list, start=1):
         s = f"{index:{len(str(len(item_list)))}}. {item}"
         if len(s) > longest_line:
             longest_line = len(s)
-    print(("-" * longest_line)[0 : os.get_terminal_size().columns - 1])
+    print(("-" * longest_line)[0 : shutil.get_terminal_size().columns - 1])
     for index, item in enumerate(printable_item_list or item_list, start=1):
         print(f"{index:{len(str(len(item_list)))}}. {item}")
 
@@ -91,48 +318,726 @@ def select_multiple_items(
             print("Invalid input. Please enter valid numbers and/or ranges.")
 
 
-def download_file(url: str, name: str):
+# one connection per host is kept open between requests, the apkmirror chain alone is 6 requests to the same host
+# and every new connection costs a tcp and tls handshake
+HTTP_TIMEOUT = 30
+
+
+class PooledHTTPResponse(http.client.HTTPResponse):
+    def __init__(self, sock, *args, pool=None, connection=None, **kwargs):
+        super().__init__(sock, *args, **kwargs)
+        self.pool = pool
+        self.connection = connection
+        self.reusable = True
+
+    def _close_conn(self):
+        super()._close_conn()
+        # the body was read completely or the response was closed, hand the connection back
+        if self.connection is not None:
+            connection, self.connection = self.connection, None
+            self.pool.release(connection, self.reusable and not self.will_close)
+
+    def close(self):
+        # leftovers of a half read body would end up in front of the next response on this connection
+        if self.fp is not None and (self.chunked or self.length):
+            self.reusable = False
+        super().close()
+
+
+class PooledHTTPSConnection(http.client.HTTPSConnection):
+    tls_session = None
+
+    def connect(self):
+        # same as HTTPSConnection.connect, but resumes the last tls session of this host when possible
+        http.client.HTTPConnection.connect(self)
+        server_hostname = self._tunnel_host or self.host
+        self.sock = self._context.wrap_socket(
+            self.sock, server_hostname=server_hostname, session=self.tls_session
+        )
+
+
+def is_connection_open(connection) -> bool:
+    return connection.sock is not None and connection.sock.fileno() != -1
+
+
+class ConnectionPool:
+    def __init__(self, max_idle_per_host: int = 8):
+        self.max_idle_per_host = max_idle_per_host
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.tls_sessions = {}
+        self.context = ssl.create_default_context()
+        self.context.set_alpn_protocols(["http/1.1"])
+
+    def acquire(self, scheme: str, host: str, timeout):
+        key = (scheme, host)
+        with self.lock:
+            connections = self.idle.get(key, [])
+            while connections:
+                connection = connections.pop()
+                if is_connection_open(connection):
+                    return connection, True
+            tls_session = self.tls_sessions.get(key)
+
+        if scheme == "https":
+            connection = PooledHTTPSConnection(
+                host, timeout=timeout, context=self.context
+            )
+            connection.tls_session = tls_session
+        else:
+            connection = http.client.HTTPConnection(host, timeout=timeout)
+        connection.pool_key = key
+        return connection, False
+
+    def release(self, connection, reusable: bool):
+        # responses that were never closed hand their connection back whenever they get garbage collected
+        if not reusable or not is_connection_open(connection):
+            connection.close()
+            return
+        with self.lock:
+            if isinstance(connection.sock, ssl.SSLSocket) and connection.sock.session:
+                self.tls_sessions[connection.pool_key] = connection.sock.session
+            connections = self.idle.setdefault(connection.pool_key, [])
+            if len(connections) < self.max_idle_per_host:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle.clear()
+
+
+class KeepAliveHandler(urllib.request.HTTPHandler, urllib.request.HTTPSHandler):
+    def __init__(self, pool: ConnectionPool):
+        urllib.request.HTTPSHandler.__init__(self, context=pool.context)
+        self.pool = pool
+
+    def http_open(self, req):
+        return self.pooled_open(req)
+
+    def https_open(self, req):
+        return self.pooled_open(req)
+
+    def pooled_open(self, req):
+        if req.has_proxy():
+            # leave proxied requests to the default urllib code path
+            if req.type == "https":
+                return self.do_open(
+                    http.client.HTTPSConnection, req, context=self.pool.context
+                )
+            return self.do_open(http.client.HTTPConnection, req)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update({k: v for k, v in req.headers.items() if k not in headers})
+        headers = {name.title(): val for name, val in headers.items()}
+
+        while True:
+            connection, reused = self.pool.acquire(req.type, req.host, req.timeout)
+            if reused and isinstance(req.timeout, (int, float)):
+                connection.sock.settimeout(req.timeout)
+            connection.response_class = functools.partial(
+                PooledHTTPResponse, pool=self.pool, connection=connection
+            )
+            try:
+                connection.request(
+                    req.get_method(),
+                    req.selector,
+                    req.data,
+                    headers,
+                    encode_chunked=req.has_header("Transfer-encoding"),
+                )
+                response = connection.getresponse()
+            except (
+                http.client.RemoteDisconnected,
+                ConnectionResetError,
+                BrokenPipeError,
+            ) as e:
+                connection.close()
+                # the server dropped the idle connection, try again on a new one
+                if reused and req.get_method() in ("GET", "HEAD"):
+                    continue
+                raise URLError(e)
+            except OSError as e:
+                connection.close()
+                raise URLError(e)
+            break
+
+        response.url = req.get_full_url()
+        # urllib expects the reason in .msg, see AbstractHTTPHandler.do_open
+        response.msg = response.reason
+        return response
+
+
+class HttpSession:
+    def __init__(self, handlers=()):
+        self.pool = ConnectionPool()
+        self.cookies = http.cookiejar.CookieJar()
+        self.handlers = list(handlers)
+        self.opener = self.build_opener()
+
+    def build_opener(self, *handlers):
+        return build_opener(
+            KeepAliveHandler(self.pool),
+            urllib.request.HTTPCookieProcessor(self.cookies),
+            *self.handlers,
+            *handlers,
+        )
+
+    def open(self, request, *handlers, timeout=HTTP_TIMEOUT):
+        # every request is a cancellation point for background work that isn't needed anymore
+        cancel = getattr(CURRENT_TASK, "cancel", None)
+        if cancel is not None and cancel.is_set():
+            raise Cancelled()
+        # extra handlers (like a redirect handler) get a one-off opener that still shares connections and cookies
+        opener = self.build_opener(*handlers) if handlers else self.opener
+        # time until the response headers arrive, every scraper hop, api call and download segment
+        url = request if isinstance(request, str) else request.full_url
+        with Span(urllib.parse.urlsplit(url).netloc, "http", url=url) as span:
+            try:
+                response = opener.open(request, timeout=timeout)
+            except HTTPError as e:
+                span.args["status"] = e.code
+                raise
+            span.args["status"] = response.status
+            return response
+
+
+SESSION = HttpSession()
+
+
+def print_progress(downloaded_bytes: int, total_size: int):
+    predefined_space = 12 + 16
+    predefined_space += len(str(ceil(downloaded_bytes)))
+
+    if total_size:
+        predefined_space += len(str(ceil(total_size)))
+        progress_percent = (downloaded_bytes / total_size) * 100
+
+        max_length = shutil.get_terminal_size()[0] - predefined_space
+        progress = "#" * int(progress_percent / 100 * max_length)
+        empty = " " * (max_length - len(progress))
+
+        # 8 fixed characters here, 4 square brackets, 1 space, 1 percent sign, 2 percent digits
+        print(
+            f"\r[{progress}{empty}] [{downloaded_bytes} / {total_size} bytes] [{int(progress_percent)}%]",
+            end="",
+            flush=True,
+        )
+    else:
+        print(
+            f"\r[{downloaded_bytes} / unknown bytes] [?%]",
+            end="",
+            flush=True,
+        )
+
+
+# files smaller than this aren't worth the extra requests of a ranged download
+RANGED_DOWNLOAD_MIN_SIZE = 4 * 1024 * 1024
+# what the first request of a download with several connections asks for, smaller files are done with it
+RANGE_PROBE_SIZE = 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+
+class DownloadRestart(Exception):
+    pass
+
+
+class BadDownload(Exception):
+    pass
+
+
+def zip_problem(path: str):
+    # apks, cli jars and patch bundles are zip files. only the first bytes and the end of central directory
+    # record are read, that's enough to tell an html error page or a cut off download from the real thing
+    size = os.path.getsize(path)
+    if size < 22:
+        return "too small to be a zip file"
+    with open(path, "rb") as file:
+        if file.read(4) != b"PK\x03\x04":
+            return "not a zip file"
+        # the record is 22 bytes followed by a comment of up to 65535 bytes
+        file.seek(max(0, size - 22 - 65535))
+        tail = file.read()
+    index = tail.rfind(b"PK\x05\x06")
+    if index < 0 or len(tail) - index < 22:
+        return "end of central directory missing, the file is cut off"
+    directory_size, directory_offset = struct.unpack(
+        "<II", tail[index + 12 : index + 20]
+    )
+    # zip64 archives keep the real values in another record
+    if directory_offset != 0xFFFFFFFF and directory_offset + directory_size > (
+        size - len(tail) + index
+    ):
+        return "central directory points past the end of the file"
+    return None
+
+
+@traced("download", "download", lambda url, name, *args, **kwargs: {"url": url})
+def download_file(
+    url: str,
+    name: str,
+    connections: int = 1,
+    progress: bool = True,
+    expected_size: int = None,
+    expected_digest: str = None,
+    zip_file: bool = False,
+) -> str:
+    # returns the sha256 of the file. a BadDownload is raised before the file is moved into place if it
+    # doesn't match the expected size or digest or isn't the zip file it should be
     print("Downloading", url, "as", name)
-    with urllib.request.urlopen(url) as response:
-        total_size = int(response.headers.get("content-length", 0))
-        downloaded_bytes = 0
+    # everything is written to a .part file first, the json sidecar records how far every byte range got
+    # so an interrupted download can be picked up again on the next run
+    part_file = name + ".part"
+    state_file = part_file + ".json"
+
+    # asking for a range tells whether the server supports them, and the response is the first range of
+    # the download instead of a request that gets thrown away. with several connections, or a download to
+    # resume that likely doesn't need the start, it's a short range so little is lost if it isn't used
+    probe = (
+        "bytes=0-%d" % (RANGE_PROBE_SIZE - 1)
+        if connections > 1 or os.path.exists(state_file)
+        else "bytes=0-"
+    )
+    try:
+        response = SESSION.open(Request(url, headers={"Range": probe}))
+    except HTTPError as e:
+        if e.code != 416:
+            raise
+        # empty files have no first byte
+        response = SESSION.open(url)
+    try:
+        headers = response.headers
+        if zip_file and headers.get_content_type() == "text/html":
+            raise BadDownload("%s is an html page, not a file" % response.url)
+        total_size = int(headers.get("content-length", 0))
+        # bytes of the file from the start that this response brings
+        covered = total_size
+        content_range = re.match(
+            r"bytes 0-(\d+)/(\d+)$", headers.get("content-range", "")
+        )
+        if response.status == 206 and content_range:
+            covered = int(content_range.group(1)) + 1
+            total_size = int(content_range.group(2))
+        if expected_size is not None and total_size and total_size != expected_size:
+            raise BadDownload(
+                "%s has %d bytes, expected %d"
+                % (response.url, total_size, expected_size)
+            )
+        accepts_ranges = (
+            response.status == 206
+            or headers.get("accept-ranges", "").lower() == "bytes"
+        )
+        state = {
+            "url": url,
+            "etag": headers.get("etag"),
+            "last_modified": headers.get("last-modified"),
+            "size": total_size,
+            "segments": None,
+        }
+
+        previous_state = read_json(state_file)
+        if (
+            accepts_ranges
+            and previous_state
+            and os.path.exists(part_file)
+            and can_resume_download(previous_state, state)
+        ):
+            state["segments"] = previous_state["segments"]
+            done = sum(pos - start for start, pos, end in state["segments"])
+            print("Resuming at %d / %d bytes" % (done, total_size))
+        else:
+            if not total_size or covered >= total_size:
+                state["segments"] = [[0, 0, total_size - 1 if total_size else None]]
+            else:
+                # cdns throttle per connection, so split the file in equal byte ranges and fetch them in parallel.
+                # the open response is the start of the first one, whoever is free first fetches the rest of it
+                parts = connections if total_size >= RANGED_DOWNLOAD_MIN_SIZE else 1
+                part_size = ceil(total_size / parts)
+                if part_size <= covered:
+                    rest = byte_ranges(covered, total_size, max(parts - 1, 1))
+                else:
+                    rest = byte_ranges(part_size, total_size, parts - 1) + [
+                        [covered, covered, part_size - 1]
+                    ]
+                state["segments"] = [[0, 0, covered - 1]] + rest
+            with open(part_file, "wb") as file:
+                # preallocate so every thread can write at its own offset
+                file.truncate(total_size)
+
+        # the response we already have is kept for a first range that starts at 0 and ends within it, a
+        # saved range that runs further is fetched on its own. a single stream is hashed on the way,
+        # ranges arrive out of order and are hashed once they're all there
+        _, pos, end = state["segments"][0]
+        if pos == 0 and (end is None or end < covered):
+            first_response = response
+        else:
+            first_response = None
+            response.close()
+        sha256 = (
+            hashlib.sha256()
+            if len(state["segments"]) == 1 and state["segments"][0][1] == 0
+            else None
+        )
+
+        try:
+            # continue on the url we got redirected to, signed download links can be slow to resolve
+            download_segments(
+                response.url,
+                part_file,
+                state,
+                state_file,
+                first_response,
+                progress,
+                sha256,
+                connections,
+            )
+        except DownloadRestart as e:
+            print(e)
+            os.remove(state_file)
+            os.remove(part_file)
+            return download_file(
+                url,
+                name,
+                connections,
+                progress,
+                expected_size,
+                expected_digest,
+                zip_file,
+            )
+    finally:
+        response.close()
+
+    digest = sha256.hexdigest() if sha256 else file_digest(part_file)
+    problem = None
+    if expected_size is not None and os.path.getsize(part_file) != expected_size:
+        problem = "%d bytes instead of %d" % (os.path.getsize(part_file), expected_size)
+    elif expected_digest and expected_digest != digest:
+        problem = "sha256 %s instead of %s" % (digest, expected_digest)
+    elif zip_file:
+        problem = zip_problem(part_file)
+    if problem:
+        # nothing worth resuming in there
+        os.remove(state_file)
+        os.remove(part_file)
+        raise BadDownload("download of %s is broken: %s" % (url, problem))
+
+    os.replace(part_file, name)
+    os.remove(state_file)
+    remember_file_digest(name, digest)
+    if not progress:
+        print("Downloaded", name)
+    return digest
+
+
+def read_json(path: str, default=None):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return default
+
+
+def write_json(path: str, data, private: bool = False):
+    # write next to the target and rename so a crash never leaves half a file behind.
+    # private files are only readable by this user, from before anything is written to them
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    descriptor = os.open(path + ".tmp", flags, 0o600 if private else 0o666)
+    if private:
+        os.chmod(path + ".tmp", 0o600)
+    with os.fdopen(descriptor, "w") as file:
+        json.dump(data, file)
+    os.replace(path + ".tmp", path)
 
-        with open(name, "wb") as file:
-            while True:
-                chunk = response.read(1024)
+
+def byte_ranges(start: int, end: int, count: int) -> list:
+    # [start, position, last byte] segments of about the same size from start up to end
+    if count < 1 or start >= end:
+        return []
+    size = ceil((end - start) / count)
+    return [
+        [first, first, min(first + size, end) - 1] for first in range(start, end, size)
+    ]
+
+
+def can_resume_download(previous_state: dict, state: dict) -> bool:
+    if previous_state.get("size") != state["size"] or not previous_state.get(
+        "segments"
+    ):
+        return False
+    # signed download links change on every scrape, so the validator is what identifies the file
+    if state["etag"] or state["last_modified"]:
+        return (previous_state.get("etag"), previous_state.get("last_modified")) == (
+            state["etag"],
+            state["last_modified"],
+        )
+    return previous_state.get("url") == state["url"]
+
+
+def download_segments(
+    url: str,
+    part_file: str,
+    state: dict,
+    state_file: str,
+    response=None,
+    progress: bool = True,
+    sha256=None,
+    connections: int = None,
+):
+    segments = state["segments"]
+    total_size = state["size"]
+    validator = state["etag"] or state["last_modified"]
+    downloaded_bytes = sum(pos - start for start, pos, end in segments)
+    lock = threading.Lock()
+    stop = threading.Event()
+    # the segment threads don't see the task state of the thread that started the download
+    cancel = getattr(CURRENT_TASK, "cancel", None) or threading.Event()
+    last_save = time.time()
+
+    def fetch_segment(segment: list, response=None):
+        nonlocal downloaded_bytes, last_save
+        start, pos, end = segment
+        if response is None:
+            r = Request(
+                url=url,
+                headers={"Range": f"bytes={pos}-{'' if end is None else end}"},
+            )
+            if validator:
+                # the server answers with the whole file instead of the range if the file changed
+                r.add_header("If-Range", validator)
+            response = SESSION.open(r)
+            if response.status != 206:
+                response.close()
+                raise DownloadRestart("File changed on the server, restarting download")
+
+        with response, open(part_file, "r+b") as file:
+            file.seek(pos)
+            while not stop.is_set():
+                if cancel.is_set():
+                    raise Cancelled()
+                # the first response runs to the end of the file, it stops where the next range starts
+                chunk = response.read(
+                    CHUNK_SIZE if end is None else min(CHUNK_SIZE, end + 1 - segment[1])
+                )
 
                 if not chunk:
                     break
 
                 file.write(chunk)
-                downloaded_bytes += len(chunk)
-                predefined_space = 12 + 16
-                predefined_space += len(str(ceil(downloaded_bytes)))
-
-                if total_size:
-                    predefined_space += len(str(ceil(total_size)))
-                    progress_percent = (downloaded_bytes / total_size) * 100
-
-                    max_length = shutil.get_terminal_size()[0] - predefined_space
-                    progress = "#" * int(progress_percent / 100 * max_length)
-                    empty = " " * (max_length - len(progress))
-
-                    # 8 fixed characters here, 4 square brackets, 1 space, 1 percent sign, 2 percent digits
-                    print(
-                        f"\r[{progress}{empty}] [{downloaded_bytes} / {total_size} bytes] [{int(progress_percent)}%]",
-                        end="",
-                        flush=True,
-                    )
-                else:
-                    print(
-                        f"\r[{downloaded_bytes} / unknown bytes] [?%]",
-                        end="",
-                        flush=True,
-                    )
+                if sha256 is not None:
+                    sha256.update(chunk)
+                # only record bytes that made it to the file
+                file.flush()
+                with lock:
+                    segment[1] += len(chunk)
+                    downloaded_bytes += len(chunk)
+                    if progress:
+                        print_progress(downloaded_bytes, total_size)
+                    if time.time() - last_save > 1:
+                        write_json(state_file, state)
+                        last_save = time.time()
+        if not stop.is_set() and end is not None and segment[1] != end + 1:
+            raise RuntimeError(f"range {start}-{end} ended early at {segment[1]}")
+
+    pending = [s for s in segments if s[2] is None or s[1] <= s[2]]
+    # the response that is already open continues the first range
+    responses = [response] + [None] * (len(pending) - 1)
+    try:
+        if len(pending) == 1:
+            fetch_segment(pending[0], response)
+        elif pending:
+            # segments after the first connections wait for a free connection
+            with ThreadPoolExecutor(
+                max_workers=min(len(pending), connections or len(pending))
+            ) as executor:
+                try:
+                    for future in [
+                        executor.submit(fetch_segment, s, r)
+                        for s, r in zip(pending, responses)
+                    ]:
+                        future.result()
+                finally:
+                    # don't wait for the other threads to finish their ranges on errors or ctrl+c
+                    stop.set()
+    finally:
+        stop.set()
+        with lock:
+            write_json(state_file, state)
+    if progress:
         print()
 
 
-# check for a token in a file to extend rate limit? https://stackoverflow.com/questions/13394077/is-there-a-way-to-increase-the-api-rate-limit-or-to-bypass-it-altogether-for-git
+def file_digest(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        while True:
+            chunk = file.read(1024 * 1024)
+
+            if not chunk:
+                break
+
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def link_file(source: str, target: str):
+    if os.path.lexists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        # shared storage on android and some windows setups don't do hard links
+        shutil.copyfile(source, target)
+        record_download(target)
+
+
+# release assets are stored once by content and linked into the repository folders, so an unchanged
+# release or a fork that ships the same upstream cli.jar doesn't download anything
+ASSET_STORE_LOCK = threading.Lock()
+ASSET_LOCKS = {}
+
+
+def fetch_release_asset(
+    asset: dict, name: str, connections: int = 1, progress: bool = True
+):
+    key = "%s:%s:%s" % (asset["id"], asset["name"], asset["size"])
+    # the same asset fetched twice at once (batch builds of one fork) is downloaded only once
+    with ASSET_STORE_LOCK:
+        lock = ASSET_LOCKS.setdefault(key, threading.Lock())
+    with lock:
+        store_release_asset(asset, key, name, connections, progress)
+
+
+def store_release_asset(
+    asset: dict, key: str, name: str, connections: int, progress: bool
+):
+    store = os.path.join(CACHE_DIR, "assets")
+    index_file = os.path.join(store, "index.json")
+    os.makedirs(store, exist_ok=True)
+
+    # the api has a digest for assets uploaded since mid 2025, blobs are named by theirs. an asset of
+    # another release or fork with the same content is linked without downloading it
+    expected_digest = asset.get("digest") or ""
+    expected_digest = (
+        expected_digest[7:] if expected_digest.startswith("sha256:") else None
+    )
+    with ASSET_STORE_LOCK:
+        digest = read_json(index_file, {}).get(key) or expected_digest
+    blob = os.path.join(store, digest) if digest else None
+    if blob and os.path.exists(blob) and os.path.getsize(blob) == asset["size"]:
+        link_asset(blob, name, digest)
+        index_asset(index_file, key, digest)
+        touch_artifact(blob)
+        print(name, "is up-to-date", "(%s)" % asset["name"])
+        return
+
+    download = os.path.join(store, "%s.download" % asset["id"])
+    digest = download_file(
+        asset["browser_download_url"],
+        download,
+        connections,
+        progress,
+        expected_size=asset["size"],
+        expected_digest=expected_digest,
+        zip_file=asset["name"].endswith((".jar", ".rvp", ".apk")),
+    )
+    blob = os.path.join(store, digest)
+    os.replace(download, blob)
+    index_asset(index_file, key, digest)
+    link_asset(blob, name, digest)
+    touch_artifact(blob)
+
+
+def index_asset(index_file: str, key: str, digest: str):
+    with ASSET_STORE_LOCK:
+        index = read_json(index_file, {})
+        if index.get(key) != digest:
+            index[key] = digest
+            write_json(index_file, index)
+
+
+def link_asset(blob: str, name: str, digest: str):
+    # without hard links name is a copy, its digest tells whether it has to be copied again
+    if os.path.exists(name) and (
+        os.path.samefile(name, blob)
+        or (
+            os.path.getsize(name) == os.path.getsize(blob)
+            and cached_file_digest(name) == digest
+        )
+    ):
+        return
+    link_file(blob, name)
+    if not os.path.samefile(name, blob):
+        remember_file_digest(name, digest)
+
+
+# a token raises the api limit from 60 to 5000 requests per hour
+# https://docs.github.com/en/rest/using-the-rest-api/rate-limits-for-the-rest-api
+GITHUB_TOKEN_FILE = os.path.abspath(".github_token")
+
+
+def github_token():
+    token = os.environ.get("GITHUB_TOKEN") or os.environ.get("GH_TOKEN")
+    if not token and os.path.exists(GITHUB_TOKEN_FILE):
+        with open(GITHUB_TOKEN_FILE) as file:
+            token = file.read()
+    return token.strip() if token else None
+
+
+@traced("github api", "github", lambda url: {"url": url})
+def github_api_request(url: str):
+    # responses are kept on disk with their validators, a 304 answer to a conditional request
+    # doesn't count against the rate limit and lets us reuse the cached body
+    # https://docs.github.com/en/rest/using-the-rest-api/best-practices-for-using-the-rest-api#use-conditional-requests-if-appropriate
+    cache_file = os.path.join(
+        CACHE_DIR, "github", hashlib.sha1(url.encode()).hexdigest() + ".json"
+    )
+    cached = read_json(cache_file)
+
+    r = Request(url=url, headers={"Accept": "application/vnd.github+json"})
+    token = github_token()
+    if token:
+        r.add_header("Authorization", "Bearer %s" % token)
+    if cached:
+        if cached["etag"]:
+            r.add_header("If-None-Match", cached["etag"])
+        if cached["last_modified"]:
+            r.add_header("If-Modified-Since", cached["last_modified"])
+
+    try:
+        # https://docs.python.org/3/library/urllib.request.html#module-urllib.response
+        # https://docs.python.org/3/library/email.message.html#email.message.EmailMessage.get_content_charset
+        with SESSION.open(r) as response:
+            content = response.read()
+            headers = response.headers
+            encoding = headers.get_content_charset() or "utf-8"
+            decoded = json.loads(content.decode(encoding))
+    except HTTPError as e:
+        if cached and e.code == 304:
+            return cached["body"], e.headers, cached["link"]
+        if cached and e.code in (403, 429):
+            print("github api refused the request (%d), using cached response" % e.code)
+            return cached["body"], e.headers, cached["link"]
+        raise
+
+    if headers.get("ETag") or headers.get("Last-Modified"):
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        write_json(
+            cache_file,
+            {
+                "url": url,
+                "etag": headers.get("ETag"),
+                "last_modified": headers.get("Last-Modified"),
+                "link": headers.get("Link"),
+                "body": decoded,
+            },
+        )
+    return decoded, headers, headers.get("Link")
+
+
 def get_github_releases(
     github_user="revanced",
     cli_repo="revanced-cli",
@@ -166,25 +1071,20 @@ def get_github_releases(
         if last_response_json is None:
             # python doesn't renew it every invocation if last_response_json parameter is set to empty array
             last_response_json = []
-        # https://docs.python.org/3/library/urllib.request.html#module-urllib.response
-        # https://docs.python.org/3/library/email.message.html#email.message.EmailMessage.get_content_charset
         print("getting", url)
-        with urllib.request.urlopen(url) as response:
-            content = response.read()
-            headers = response.headers
-            encoding = headers.get_content_charset()
-            decoded = json.loads(content.decode(encoding))
+        decoded, headers, link_header = github_api_request(url)
 
-            # put the /latest response in a list for consistency
-            if type(decoded) == dict:
-                decoded = [decoded]
+        # put the /latest response in a list for consistency
+        if type(decoded) == dict:
+            decoded = [decoded]
 
-            last_response_json.extend(decoded)
-            response_json = last_response_json
+        last_response_json.extend(decoded)
+        response_json = last_response_json
 
-            requests_ratelimit = headers.get("X-RateLimit-Limit")
-            requests_remaining = headers.get("X-RateLimit-Remaining")
-            requests_used = headers.get("X-RateLimit-Used")
+        requests_ratelimit = headers.get("X-RateLimit-Limit")
+        requests_remaining = headers.get("X-RateLimit-Remaining")
+        requests_used = headers.get("X-RateLimit-Used")
+        if requests_ratelimit and requests_used:
             ratelimit_reset_epoch = int(headers.get("X-RateLimit-Reset"))
             ratelimit_reset_formatted_time = time.strftime(
                 "%Y-%m-%d %H:%M:%S", time.localtime(ratelimit_reset_epoch)
@@ -193,27 +1093,26 @@ def get_github_releases(
                 f"Used {requests_used} out of {requests_ratelimit} github requests. {requests_remaining} remaining. Resets at: {ratelimit_reset_formatted_time}."
             )
 
-            # should make this wait until reset if we hit ratelimit
-            # round(time.time()) - ratelimit_reset_epoch
-
-            link_header = headers.get("Link")
-            page = {}
-            if link_header:
-                # turn the link header string into a dict
-                a = [s.strip() for s in link_header.split(",")]
-                b = [s.strip() for list in [s.split(";") for s in a] for s in list]
-                c = {b.pop(1)[5:-1]: b.pop(0)[1:-1] for i in range(int(len(b) / 2))}
-                page = c
-
-            if "next" in page:
-                if target == 0 or len(response_json) < target:
-                    return request_json(
-                        page["next"],
-                        target,
-                        last_response_json=response_json,
-                    )
+        # should make this wait until reset if we hit ratelimit
+        # round(time.time()) - ratelimit_reset_epoch
+
+        page = {}
+        if link_header:
+            # turn the link header string into a dict
+            a = [s.strip() for s in link_header.split(",")]
+            b = [s.strip() for list in [s.split(";") for s in a] for s in list]
+            c = {b.pop(1)[5:-1]: b.pop(0)[1:-1] for i in range(int(len(b) / 2))}
+            page = c
+
+        if "next" in page:
+            if target == 0 or len(response_json) < target:
+                return request_json(
+                    page["next"],
+                    target,
+                    last_response_json=response_json,
+                )
 
-            return response_json if target == 0 else response_json[0:target]
+        return response_json if target == 0 else response_json[0:target]
 
     response = {}
     for x in get:
@@ -221,10 +1120,89 @@ def get_github_releases(
     return response
 
 
+# urls found while scraping, every hop has its own lifetime. app pages practically never move, release and
+# variant pages of a specific version stay put for a while, signed download links and tokens expire quickly
+APP_PAGE_TTL = 30 * 24 * 60 * 60
+RELEASE_PAGE_TTL = 7 * 24 * 60 * 60
+DOWNLOAD_URL_TTL = 10 * 60
+
+
+class ScrapeCache:
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = None
+
+    def load(self):
+        if self.entries is None:
+            self.entries = read_json(self.path, {})
+
+    def save(self):
+        now = time.time()
+        self.entries = {k: v for k, v in self.entries.items() if v["expires"] > now}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        write_json(self.path, self.entries)
+
+    def get(self, key: str):
+        with self.lock:
+            self.load()
+            entry = self.entries.get(key)
+            if entry and entry["expires"] > time.time():
+                return entry["value"]
+            return None
+
+    def set(self, key: str, value, ttl: int):
+        with self.lock:
+            self.load()
+            self.entries[key] = {"value": value, "expires": time.time() + ttl}
+            self.save()
+
+    def invalidate(self, prefix: str, package_name: str):
+        # keys look like <source>:<hop>:<package name>[:<version>]
+        with self.lock:
+            self.load()
+            self.entries = {
+                k: v
+                for k, v in self.entries.items()
+                if not (k.startswith(prefix) and k.split(":")[2] == package_name)
+            }
+            self.save()
+
+
+SCRAPE_CACHE = ScrapeCache(os.path.join(CACHE_DIR, "scrape.json"))
+
+
 # nice urllib guide https://devdocs.io/python~3.10/howto/urllib2#urllib-howto
 def apkcombo(package_name: str, version: str = "") -> str:
     print = lambda *args: p("apkcombo:", *args)
 
+    cache_key = "apkcombo:download:%s:%s" % (package_name, version)
+    url_fist_part = SCRAPE_CACHE.get(cache_key)
+    if url_fist_part:
+        print("using cached download page result")
+    else:
+        url_fist_part = apkcombo_download_url(package_name, version)
+        SCRAPE_CACHE.set(cache_key, url_fist_part, DOWNLOAD_URL_TTL)
+
+    # the checkin token doesn't depend on the app, one is enough for all downloads in a short while
+    token = SCRAPE_CACHE.get("apkcombo:checkin")
+    if not token:
+        with Span("apkcombo checkin", "scrape"), SESSION.open(
+            Request("https://apkcombo.com/checkin")
+        ) as response:
+            content = response.read()
+            headers = response.headers
+            encoding = headers.get_content_charset()
+            # fp=e1aa154442d600ccbfa78e01a042344e&ip=yourip
+            token = content.decode(encoding)
+        SCRAPE_CACHE.set("apkcombo:checkin", token, DOWNLOAD_URL_TTL)
+    return url_fist_part + "&" + token
+
+
+@traced("apkcombo download page", "scrape")
+def apkcombo_download_url(package_name: str, version: str = "") -> str:
+    print = lambda *args: p("apkcombo:", *args)
+
     # this is either 404 or redirects to the app page with the latest version or the specified version
     # will also redirect to a /old-versions/ app page if specified version is not available (anymore)
     url = (
@@ -237,7 +1215,7 @@ def apkcombo(package_name: str, version: str = "") -> str:
     print("requesting", url)
     r = Request(url=url, headers={"Referer": "https://apkcombo.com/"})
     try:
-        response = urlopen(r)
+        response = SESSION.open(r)
     except HTTPError as e:
         if e.code == 404:
             print("package not found")
@@ -266,154 +1244,191 @@ def apkcombo(package_name: str, version: str = "") -> str:
             print(msg)
             raise RuntimeError(msg)
 
-        url_fist_part = url_fist_part.group()
+        # taken from an href, so &amp; and friends are still escaped
+        url_fist_part = html.unescape(url_fist_part.group())
         if not url_fist_part.startswith("http"):
             url_fist_part = "https://apkcombo.com" + url_fist_part
-
-        with urlopen(Request("https://apkcombo.com/checkin")) as response:
-            content = response.read()
-            headers = response.headers
-            encoding = headers.get_content_charset()
-            # fp=e1aa154442d600ccbfa78e01a042344e&ip=yourip
-            decoded = content.decode(encoding)
-            return url_fist_part + "&" + decoded
+        return url_fist_part
 
 
 def apkmirror(package_name: str, version: str = "") -> str:
     print = lambda *args: p("apkmirror:", *args)
 
-    # there's no redirect by package name on apkmirror, we scrape the serach page
-    # still, there are some package names that aren't unique, like https://www.apkmirror.com/?post_type=app_release&searchtype=app&s=%22com.google.android.youtube%22
-    # and https://www.apkmirror.com/?post_type=app_release&searchtype=app&s=%22com.google.android.apps.youtube.music%22
-    # so user confirmation will be needed sometimes
-    url = f"https://www.apkmirror.com/?post_type=app_release&searchtype=app&s=%22{package_name}%22"
-    base_url = "https://www.apkmirror.com"
+    cache_key = "apkmirror:download:%s:%s" % (package_name, version)
+    url = SCRAPE_CACHE.get(cache_key)
+    if url:
+        print("using cached download url")
+        return url
 
+    try:
+        url = apkmirror_scrape(package_name, version, use_cache=True)
+    except HTTPError as e:
+        # a 404 from a freshly scraped url is an answer, like a version that isn't on apkmirror
+        if e.code != 404 or not getattr(e, "from_cache", False):
+            raise e
+        # one of the cached pages is gone, forget everything about this app and start over from the search
+        print("cached page returned 404, scraping again")
+        SCRAPE_CACHE.invalidate("apkmirror:", package_name)
+        url = apkmirror_scrape(package_name, version, use_cache=False)
+    if url:
+        SCRAPE_CACHE.set(cache_key, url, DOWNLOAD_URL_TTL)
+    return url
+
+
+def apkmirror_scrape(package_name: str, version: str = "", use_cache=True) -> str:
+    print = lambda *args: p("apkmirror:", *args)
+
+    base_url = "https://www.apkmirror.com"
     headers = {
         "User-Agent": USER_AGENT,
     }
 
-    print("requesting", url)
-    r = Request(url=url, headers=headers)
-    response = urlopen(r)
-    content = response.read()
-    response_headers = response.headers
-    encoding = response_headers.get_content_charset()
-    decoded = content.decode(encoding)
-
-    results_regex = re.compile(
-        "(?<=<!-- Nav tabs -->).*?(?=<!-- #primary -->)", flags=re.S
-    )
-    results = re.search(results_regex, decoded).group()
-    # should crash at .group() above if regex gets outdated
-    app_url_regex = r'(?<=fontBlack" href=")[^"]+'
-    possible_apps = re.findall(app_url_regex, results)
-    if not possible_apps:
-        msg = "no search results detected"
-        print(msg)
-        raise RuntimeError(msg)
-    print("detected %d search results" % len(possible_apps))
-    # possible_apps = [base_url + i for i in possible_apps]
-    app = (
-        possible_apps[0]
-        if len(possible_apps) == 1
-        else select_one_item("Pick app: ", possible_apps)
-    )
-
-    url = base_url + app
-    print("requesting", url)
-    r = Request(url=url, headers=headers)
-    response = urlopen(r)
-    content = response.read()
-    response_headers = response.headers
-    encoding = response_headers.get_content_charset()
-    decoded = content.decode(encoding)
-
-    all_releases_regex = re.compile("All versions(.*?)See more uploads", flags=re.S)
-    releases = re.search(all_releases_regex, decoded).group(1)
-    latest_release_regex = r'(?<=class="fontBlack" href=")[^"]+'
-    url = latest_release_url = (
-        base_url + re.search(latest_release_regex, releases).group()
-    )
-
-    if version:
-        version = version.replace(".", "-")
-        version_from_url = re.search(
-            r"(?<=-)[\d|-]+(?=-release)", latest_release_url
-        ).group()
-        url = url.replace(version_from_url, version)
-
-    print("requesting", url)
-    # this will 404 if version is not found
-    r = Request(url=url, headers=headers)
-    response = urlopen(r)
-    content = response.read()
-    response_headers = response.headers
-    encoding = response_headers.get_content_charset()
-    decoded = content.decode(encoding)
-
-    # downloads_regex = re.compile(
-    #     '<h3 class="addpadding tabs-header ".*?<div class="listWidget', flags=re.S
-    # )
-    # downloads = re.search(downloads_regex, decoded).group()
-    # stated_amount_of_downloads = re.search(r"we currently have (\d+)", decoded).group(1)
-
-    # this regex seems to work well on the full response without filtering downloads first
-    variants_regex = re.compile(
-        '(?<!table topmargin variants-table">\n {16})<div class="table-row headerFont">.*?href="([^"]+).*?span class="apkm-badge[^>]+>([a-zA-Z0-9_]+)</span>.*?href="[^#]+#disqus_thread".*?</div>\n((?: +<div class="table-cell rowheight addseparator expand pad dowrap">[^<]+</div>\n)+)',
-        flags=re.S,
-    )
-    # variants = re.findall(variants_regex, downloads)
-    variants = re.findall(variants_regex, decoded)
-    variants = [(i[0], i[1], re.findall(r'dowrap">([^<]+)<', i[2])) for i in variants]
-    # variants is a list of tuples like ('/apk/google-inc/youtube-music/youtube-music-7-33-51-release/youtube-music-7-33-51-android-apk-download/', 'APK', ['armeabi-v7a', 'Android 8.0+', 'nodpi']
-    # print(variants)
-    variants = [i for i in variants if i[1] == "APK"]
-    variants = [i for i in variants if i[2][0] in ["arm64-v8a", "universal"]]
-    assert len(variants) > 0, "no variants found"
-    # print(variants)
-
-    variant = (
-        variants[0]
-        if len(variants) == 1
-        else select_one_item("Pick variant: ", variants)
-    )
-    url = base_url + variant[0]
-    print("requesting", url)
-    r = Request(url=url, headers=headers)
-    response = urlopen(r)
-    content = response.read()
-    response_headers = response.headers
-    encoding = response_headers.get_content_charset()
-    decoded = content.decode(encoding)
+    # urls that came out of the scrape cache, a 404 on one of them means the cache is outdated
+    cached_urls = set()
 
-    regex = r'(?<=href=")\/apk\/.*?\?key=\w+[^"]+'
-    url = base_url + re.search(regex, decoded).group()
-    print("requesting", url)
-    r = Request(url=url, headers=headers)
-    response = urlopen(r)
-    content = response.read()
-    response_headers = response.headers
-    encoding = response_headers.get_content_charset()
-    decoded = content.decode(encoding)
+    def request(url: str, page: str) -> str:
+        print("requesting", url)
+        r = Request(url=url, headers=headers)
+        with Span("apkmirror " + page, "scrape", url=url):
+            try:
+                response = SESSION.open(r)
+            except HTTPError as e:
+                e.from_cache = url in cached_urls
+                raise e
+            with response:
+                content = response.read()
+                response_headers = response.headers
+                encoding = response_headers.get_content_charset()
+                return content.decode(encoding)
 
-    regex = r'<a id="download-link"(?: [a-zA-Z0-9_-]+="[^"]+")+ href="([^"]+)"'
-    url = base_url + re.search(regex, decoded).group(1)
+    # pages of the latest release change with every update, only specific versions are cached
+    app_key = "apkmirror:app:%s" % package_name
+    release_key = "apkmirror:release:%s:%s" % (package_name, version)
+    variant_key = "apkmirror:variant:%s:%s" % (package_name, version)
+    app = use_cache and SCRAPE_CACHE.get(app_key)
+    release_url = use_cache and version and SCRAPE_CACHE.get(release_key)
+    variant_url = use_cache and version and SCRAPE_CACHE.get(variant_key)
+    if app:
+        cached_urls.add(base_url + app)
+    cached_urls.update(url for url in [release_url, variant_url] if url)
 
-    class NoRedirectHandler(HTTPRedirectHandler):
-        def http_error_302(self, req, fp, code, msg, headers):
-            # raise Exception(f"Redirect detected: {headers.get('Location')}")
-            x = Exception("redirect detected")
-            x.location = headers.get("Location")
-            raise x
+    if not variant_url and not release_url and not app:
+        # there's no redirect by package name on apkmirror, we scrape the serach page
+        # still, there are some package names that aren't unique, like https://www.apkmirror.com/?post_type=app_release&searchtype=app&s=%22com.google.android.youtube%22
+        # and https://www.apkmirror.com/?post_type=app_release&searchtype=app&s=%22com.google.android.apps.youtube.music%22
+        # so user confirmation will be needed sometimes
+        url = f"https://www.apkmirror.com/?post_type=app_release&searchtype=app&s=%22{package_name}%22"
+        decoded = request(url, "search")
+
+        results_regex = re.compile(
+            "(?<=<!-- Nav tabs -->).*?(?=<!-- #primary -->)", flags=re.S
+        )
+        results = re.search(results_regex, decoded).group()
+        # should crash at .group() above if regex gets outdated
+        app_url_regex = r'(?<=fontBlack" href=")[^"]+'
+        possible_apps = re.findall(app_url_regex, results)
+        if not possible_apps:
+            msg = "no search results detected"
+            print(msg)
+            raise RuntimeError(msg)
+        print("detected %d search results" % len(possible_apps))
+        # possible_apps = [base_url + i for i in possible_apps]
+        app = (
+            possible_apps[0]
+            if len(possible_apps) == 1
+            else select_one_item(
+                "Pick app: ", possible_apps, answer_key="apkmirror_app"
+            )
+        )
+        SCRAPE_CACHE.set(app_key, app, APP_PAGE_TTL)
+
+    if not variant_url and not release_url:
+        url = base_url + app
+        decoded = request(url, "app page")
+
+        all_releases_regex = re.compile("All versions(.*?)See more uploads", flags=re.S)
+        releases = re.search(all_releases_regex, decoded).group(1)
+        latest_release_regex = r'(?<=class="fontBlack" href=")[^"]+'
+        release_url = latest_release_url = (
+            base_url + re.search(latest_release_regex, releases).group()
+        )
+
+        if version:
+            version_from_url = re.search(
+                r"(?<=-)[\d|-]+(?=-release)", latest_release_url
+            ).group()
+            release_url = release_url.replace(
+                version_from_url, version.replace(".", "-")
+            )
+
+    if not variant_url:
+        # this will 404 if version is not found
+        decoded = request(release_url, "release page")
+        # cached only once it exists, a version that isn't there yet is looked up again next time
+        if version and release_url not in cached_urls:
+            SCRAPE_CACHE.set(release_key, release_url, RELEASE_PAGE_TTL)
+
+        # downloads_regex = re.compile(
+        #     '<h3 class="addpadding tabs-header ".*?<div class="listWidget', flags=re.S
+        # )
+        # downloads = re.search(downloads_regex, decoded).group()
+        # stated_amount_of_downloads = re.search(r"we currently have (\d+)", decoded).group(1)
+
+        # this regex seems to work well on the full response without filtering downloads first
+        variants_regex = re.compile(
+            '(?<!table topmargin variants-table">\n {16})<div class="table-row headerFont">.*?href="([^"]+).*?span class="apkm-badge[^>]+>([a-zA-Z0-9_]+)</span>.*?href="[^#]+#disqus_thread".*?</div>\n((?: +<div class="table-cell rowheight addseparator expand pad dowrap">[^<]+</div>\n)+)',
+            flags=re.S,
+        )
+        # variants = re.findall(variants_regex, downloads)
+        variants = re.findall(variants_regex, decoded)
+        variants = [
+            (i[0], i[1], re.findall(r'dowrap">([^<]+)<', i[2])) for i in variants
+        ]
+        # variants is a list of tuples like ('/apk/google-inc/youtube-music/youtube-music-7-33-51-release/youtube-music-7-33-51-android-apk-download/', 'APK', ['armeabi-v7a', 'Android 8.0+', 'nodpi']
+        # print(variants)
+        variants = [i for i in variants if i[1] == "APK"]
+        variants = [i for i in variants if i[2][0] in ["arm64-v8a", "universal"]]
+        assert len(variants) > 0, "no variants found"
+        # print(variants)
+
+        variant = (
+            variants[0]
+            if len(variants) == 1
+            else select_one_item(
+                "Pick variant: ",
+                variants,
+                lambda x: " ".join([x[1]] + x[2]),
+                answer_key="variant",
+            )
+        )
+        variant_url = base_url + variant[0]
+        if version:
+            SCRAPE_CACHE.set(variant_key, variant_url, RELEASE_PAGE_TTL)
+
+    decoded = request(variant_url, "variant page")
+
+    regex = r'(?<=href=")\/apk\/.*?\?key=\w+[^"]+'
+    url = base_url + re.search(regex, decoded).group()
+    decoded = request(url, "download page")
+
+    regex = r'<a id="download-link"(?: [a-zA-Z0-9_-]+="[^"]+")+ href="([^"]+)"'
+    url = base_url + re.search(regex, decoded).group(1)
+
+    class NoRedirectHandler(HTTPRedirectHandler):
+        def http_error_302(self, req, fp, code, msg, headers):
+            # raise Exception(f"Redirect detected: {headers.get('Location')}")
+            x = Exception("redirect detected")
+            x.location = headers.get("Location")
+            raise x
 
     print("requesting", url)
-    opener = build_opener(NoRedirectHandler())
     r = Request(url=url, headers=headers)
     try:
-        with opener.open(r) as response:
+        with SESSION.open(r, NoRedirectHandler()) as response:
             pass
     except Exception as e:
+        if not hasattr(e, "location"):
+            raise e
         url = e.location
         print(url)
         return url
@@ -422,74 +1437,2195 @@ def apkmirror(package_name: str, version: str = "") -> str:
 def apkpure(package_name: str, version: str = "") -> str:
     print = lambda *args: p("apkpure:", *args)
 
-    # can also format links like this if needed in the future https://apkpure.com/-/com.google.android.youtube
-    url = (
-        "https://apkpure.com/search/"
-        + package_name
-        + ("/download" if not version else f"/download/{version}")
+    cache_key = "apkpure:download:%s:%s" % (package_name, version)
+    url = SCRAPE_CACHE.get(cache_key)
+    if url:
+        print("using cached download url")
+        return url
+
+    # can also format links like this if needed in the future https://apkpure.com/-/com.google.android.youtube
+    url = (
+        "https://apkpure.com/search/"
+        + package_name
+        + ("/download" if not version else f"/download/{version}")
+    )
+    headers = {
+        "User-Agent": USER_AGENT,
+    }
+
+    print("requesting", url)
+    r = Request(url=url, headers=headers)
+    try:
+        response = SESSION.open(r)
+    except HTTPError as e:
+        if e.code == 404:
+            print("package not found")
+            raise e
+        else:
+            raise e
+
+    else:
+        if response.url.__contains__("/apk-downloader"):
+            msg = "version %s not found, likely too old" % version
+            print(msg)
+            raise RuntimeError(msg)
+
+        content = response.read()
+        response_headers = response.headers
+        encoding = response_headers.get_content_charset()
+        decoded = content.decode(encoding)
+
+        regex = r'https://d\.apkpure\.com/b/APK/.*?\?versionCode=\d+.*?(?=")'
+        url = re.search(regex, decoded)
+        if url == None:
+            msg = "did not find standalone apk"
+            print(msg)
+            raise RuntimeError(msg)
+        url = url.group()  # .replace("&amp;", "&")
+
+        class NoRedirectHandler(HTTPRedirectHandler):
+            def http_error_302(self, req, fp, code, msg, headers):
+                # raise Exception(f"Redirect detected: {headers.get('Location')}")
+                x = Exception("redirect detected")
+                x.location = headers.get("Location")
+                raise x
+
+        print("requesting", url)
+        r = Request(url=url, headers=headers)
+        try:
+            with SESSION.open(r, NoRedirectHandler()) as response:
+                pass
+        except Exception as e:
+            if not hasattr(e, "location"):
+                raise e
+            url = e.location
+            SCRAPE_CACHE.set(cache_key, url, DOWNLOAD_URL_TTL)
+            return url
+
+
+# downloaded apks are kept per package, version and source so other builds of the same version
+# (different patch selections, forks) don't download them again
+def stored_apk_path(package_name: str, version: str, source_name: str) -> str:
+    folder = os.path.join(CACHE_DIR, "apks", package_name, version)
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, source_name + ".apk")
+
+
+def store_apk(apk_file: str, url: str):
+    write_json(
+        apk_file + ".json",
+        {"size": os.path.getsize(apk_file), "url": url, "downloaded": time.time()},
+    )
+    touch_artifact(apk_file)
+
+
+def find_stored_apk(package_name: str, version: str, source_names: list):
+    for source_name in source_names:
+        apk_file = os.path.join(
+            CACHE_DIR, "apks", package_name, version, source_name + ".apk"
+        )
+        info = read_json(apk_file + ".json")
+        if not info or not os.path.exists(apk_file):
+            continue
+        # quick check, a full hash of a 150mb file would cost more than it saves on a phone
+        if os.path.getsize(apk_file) == info["size"] and not zip_problem(apk_file):
+            touch_artifact(apk_file)
+            return apk_file
+        print("Stored apk", apk_file, "is damaged, ignoring it")
+    return None
+
+
+APK_SOURCES = [
+    apkcombo,
+    apkmirror,
+    apkpure,
+]
+
+
+def race_apk_sources(apk_sources: list, package_name: str, version: str = ""):
+    # all sources scrape at the same time and the first download url wins, a slow or hanging source
+    # doesn't hold up the others. prompts can't be answered from a worker thread, sources that need
+    # the user to pick something are retried in the foreground only if no other source succeeded
+    results = queue.Queue()
+    cancel = threading.Event()
+    # when the race itself runs as a background task its sources print along with it
+    output = getattr(CURRENT_TASK, "output", None)
+    outer_cancel = getattr(CURRENT_TASK, "cancel", None)
+    answers = getattr(CURRENT_TASK, "answers", None)
+
+    def worker(source):
+        CURRENT_TASK.defer_prompts = True
+        CURRENT_TASK.cancel = cancel
+        CURRENT_TASK.output = output
+        CURRENT_TASK.answers = answers
+        try:
+            with Span(source.__name__, "scrape"):
+                url = source(package_name=package_name, version=version)
+            results.put((source, url, None))
+        except Exception as e:
+            results.put((source, None, e))
+
+    for source in apk_sources:
+        # daemon threads, a source stuck on a dead connection must not keep the script alive
+        threading.Thread(target=worker, args=(source,), daemon=True).start()
+
+    deferred = []
+    selection = None
+    try:
+        for _ in apk_sources:
+            while True:
+                try:
+                    source, url, error = results.get(timeout=0.5)
+                    break
+                except queue.Empty:
+                    if outer_cancel is not None and outer_cancel.is_set():
+                        raise Cancelled()
+            if url and url.startswith("http"):
+                print("Using", source.__name__, "download")
+                return source, url
+            if isinstance(error, SelectionRequired):
+                print("\t%s needs a selection, deferred" % source.__name__)
+                deferred.append(source)
+                selection = selection or error
+            elif error:
+                tb = "".join(
+                    traceback.format_exception(type(error), error, error.__traceback__)
+                )
+                print("\t%s failed" % source.__name__, error, "\n", tb, "\n")
+            else:
+                print("\t%s failed to find a download url" % source.__name__)
+    finally:
+        cancel.set()
+
+    if deferred and getattr(CURRENT_TASK, "defer_prompts", False):
+        # still in the background, the caller runs the deferred sources where prompts work
+        selection.deferred = deferred
+        raise selection
+    return run_deferred_sources(deferred, package_name, version)
+
+
+def run_deferred_sources(deferred: list, package_name: str, version: str = ""):
+    for source in deferred:
+        try:
+            with Span(source.__name__, "scrape"):
+                url = source(package_name=package_name, version=version)
+            if url:
+                return source, url
+        except SelectionRequired:
+            # headless, there is nobody to ask
+            raise
+        except Exception as e:
+            tb = traceback.format_exc()
+            print("\tfailed", e, "\n", tb, "\n")
+    return None, None
+
+
+APK_LOCKS_LOCK = threading.Lock()
+APK_LOCKS = {}
+
+
+def fetch_apk(
+    package_name: str,
+    version: str,
+    apk_sources: list,
+    connections: int = 1,
+    progress: bool = True,
+    unversioned_file: str = "apk.apk",
+    deferred_sources: list = None,
+) -> str:
+    # deferred_sources are the ones a race in the background left for the foreground, the others failed
+    source_names = [source.__name__ for source in apk_sources]
+    apk_file = version and find_stored_apk(package_name, version, source_names)
+    if apk_file:
+        print("Using stored apk", apk_file)
+        return apk_file
+
+    apk_source, apk_url = (
+        run_deferred_sources(deferred_sources, package_name, version)
+        if deferred_sources
+        else race_apk_sources(apk_sources, package_name, version)
+    )
+    assert apk_url, "Failed to scrape apk url."
+    # without a version there is nothing to tell the stored apk apart from the next release
+    apk_file = (
+        stored_apk_path(package_name, version, apk_source.__name__)
+        if version
+        else unversioned_file
+    )
+    # batch builds that asked for different sources can still end up with the same file
+    with APK_LOCKS_LOCK:
+        lock = APK_LOCKS.setdefault(os.path.abspath(apk_file), threading.Lock())
+    with lock:
+        if version and find_stored_apk(package_name, version, [apk_source.__name__]):
+            print("Using stored apk", apk_file)
+            return apk_file
+        try:
+            download_file(apk_url, apk_file, connections, progress, zip_file=True)
+        except (HTTPError, BadDownload) as e:
+            # a cached download url can expire before its time is up
+            SCRAPE_CACHE.invalidate(apk_source.__name__ + ":download:", package_name)
+            raise e
+        if version:
+            store_apk(apk_file, apk_url)
+        else:
+            record_download(apk_file)
+    return apk_file
+
+
+# revanced-cli commands can run in a jvm that stays alive between commands and runs, started with --daemon.
+# it keeps cli.jar loaded and listens on a local port, see CLI_DAEMON_SOURCE. the daemon exits on its own
+# after CLI_DAEMON_IDLE_TIMEOUT seconds without commands
+USE_CLI_DAEMON = False
+CLI_DAEMON_IDLE_TIMEOUT = 15 * 60
+CLI_DAEMON_CONNECT_TIMEOUT = 5
+# longest a command may go without printing anything before the daemon counts as hung
+CLI_DAEMON_READ_TIMEOUT = 30 * 60
+CLI_DAEMON_SOURCE = r"""
+import java.io.*;
+import java.lang.reflect.*;
+import java.net.*;
+import java.nio.charset.StandardCharsets;
+import java.security.MessageDigest;
+import java.security.SecureRandom;
+import java.util.logging.*;
+
+// keeps revanced-cli loaded and runs its commands for revanced.py, one at a time
+public class CliDaemon {
+    // System.out and System.err of the cli end up here, pointed at the socket of the running command
+    static class SwitchStream extends OutputStream {
+        volatile OutputStream target;
+
+        @Override
+        public void write(int b) throws IOException {
+            OutputStream t = target;
+            if (t != null) t.write(b);
+        }
+
+        @Override
+        public void write(byte[] b, int off, int len) throws IOException {
+            OutputStream t = target;
+            if (t != null) t.write(b, off, len);
+        }
+
+        @Override
+        public void flush() throws IOException {
+            OutputStream t = target;
+            if (t != null) t.flush();
+        }
+    }
+
+    public static void main(String[] args) throws Exception {
+        PrintStream stdout = System.out;
+        SwitchStream output = new SwitchStream();
+        PrintStream stream = new PrintStream(output, true, "UTF-8");
+        System.setOut(stream);
+        System.setErr(stream);
+
+        // the log format the cli sets up in its own main function, which can't be used because it exits
+        System.setProperty("java.util.logging.SimpleFormatter.format", "%4$s: %5$s %n");
+        LogManager.getLogManager().reset();
+        Logger.getLogger("").addHandler(new StreamHandler(stream, new SimpleFormatter()) {
+            @Override
+            public synchronized void publish(LogRecord record) {
+                super.publish(record);
+                flush();
+            }
+        });
+
+        Object mainCommand;
+        Constructor<?> commandLine;
+        Method execute;
+        try {
+            URLClassLoader loader = new URLClassLoader(
+                    new URL[] {new File(args[0]).toURI().toURL()}, CliDaemon.class.getClassLoader());
+            Thread.currentThread().setContextClassLoader(loader);
+            Class<?> mainCommandClass = Class.forName("app.revanced.cli.command.MainCommand", true, loader);
+            Field instance = mainCommandClass.getDeclaredField("INSTANCE");
+            instance.setAccessible(true);
+            mainCommand = instance.get(null);
+            Class<?> commandLineClass = Class.forName("picocli.CommandLine", true, loader);
+            commandLine = commandLineClass.getConstructor(Object.class);
+            execute = commandLineClass.getMethod("execute", String[].class);
+        } catch (Throwable e) {
+            stdout.println("UNSUPPORTED " + e);
+            stdout.flush();
+            return;
+        }
+
+        // every request has to start with this token. only revanced.py reads it from the pipe and keeps it in a
+        // file nobody else can read, other local processes that find the port can't run commands
+        byte[] random = new byte[32];
+        new SecureRandom().nextBytes(random);
+        StringBuilder token = new StringBuilder();
+        for (byte b : random) token.append(Integer.toHexString((b & 0xff) | 0x100).substring(1));
+        byte[] expected = token.toString().getBytes(StandardCharsets.UTF_8);
+
+        ServerSocket server = new ServerSocket(0, 50, InetAddress.getLoopbackAddress());
+        server.setSoTimeout(Integer.parseInt(args[1]) * 1000);
+        stdout.println("PORT " + server.getLocalPort() + " " + token);
+        stdout.flush();
+
+        while (true) {
+            Socket socket;
+            try {
+                socket = server.accept();
+            } catch (SocketTimeoutException e) {
+                // nobody needed the cli for a while
+                System.exit(0);
+                return;
+            }
+            try (Socket s = socket) {
+                // a client that connects and sends nothing doesn't hold up the next one
+                s.setSoTimeout(10000);
+                BufferedReader reader = new BufferedReader(
+                        new InputStreamReader(s.getInputStream(), StandardCharsets.UTF_8));
+                String line = reader.readLine();
+                if (line == null || !MessageDigest.isEqual(line.getBytes(StandardCharsets.UTF_8), expected)) {
+                    continue;
+                }
+                String[] argv = new String[Integer.parseInt(reader.readLine())];
+                for (int i = 0; i < argv.length; i++) argv[i] = reader.readLine();
+                s.setSoTimeout(0);
+
+                OutputStream socketOutput = new BufferedOutputStream(s.getOutputStream());
+                output.target = socketOutput;
+                int code;
+                try {
+                    code = (Integer) execute.invoke(commandLine.newInstance(mainCommand), (Object) argv);
+                } catch (Throwable e) {
+                    e.printStackTrace();
+                    code = 1;
+                }
+                stream.flush();
+                output.target = null;
+                // a zero byte never shows up in the cli output, the exit code follows it
+                socketOutput.write(0);
+                socketOutput.write(Integer.toString(code).getBytes(StandardCharsets.UTF_8));
+                socketOutput.flush();
+            } catch (Exception e) {
+                output.target = null;
+            }
+        }
+    }
+}
+"""
+
+
+# class data sharing archive of the classes cli.jar loads. the first jvm that runs a cli.jar on a given java
+# dumps it when it exits and later ones map it, which skips most of the class loading on startup (java 13+)
+# https://docs.oracle.com/en/java/javase/21/vm/class-data-sharing.html
+USE_CDS = True
+JAVA_INFO = None
+
+
+def java_info() -> dict:
+    # only probed again when the resolved java binary changes
+    global JAVA_INFO
+    if JAVA_INFO is None:
+        java = shutil.which("java")
+        if java is None:
+            raise FileNotFoundError("java")
+        java = os.path.realpath(java)
+        key = "java:%s:%d" % (java, os.stat(java).st_mtime_ns)
+        JAVA_INFO = cached_probe(key, lambda: probe_java(java))
+    return JAVA_INFO
+
+
+@traced("java probe", "subprocess")
+def probe_java(java: str) -> dict:
+    # one jvm launch tells both the version and whether this build of java can dump cds archives,
+    # some termux builds come without cds
+    output = subprocess.run(
+        [java, "-XX:+PrintFlagsFinal", "-version"],
+        capture_output=True,
+        text=True,
+    )
+    first_line = output.stderr.split("\n")[0]
+    regex = r"^\w+ version \"?(\d{1,2})"
+    match = re.match(regex, first_line)
+    major = int(match.group(1)) if match else 0
+    return {
+        "path": java,
+        "version": first_line,
+        "major": major,
+        "cds": major >= 13 and "ArchiveClassesAtExit" in output.stdout,
+    }
+
+
+def cds_options(cli_jar: str):
+    if not USE_CDS or not java_info()["cds"]:
+        return [], None
+    info = java_info()
+    # a new cli.jar or another java gets its own archive, old ones are cleaned up by gc
+    java_key = hashlib.sha1(
+        (
+            "%s %s %s" % (info["path"], os.path.getmtime(info["path"]), info["version"])
+        ).encode()
+    ).hexdigest()[:12]
+    folder = os.path.join(CACHE_DIR, "cds")
+    archive = os.path.join(
+        folder, "%s-%s.jsa" % (cached_file_digest(cli_jar)[:16], java_key)
+    )
+    # cds warnings are printed to stdout and would end up in the parsed output of list commands
+    quiet = ["-Xshare:auto", "-Xlog:disable", "-Xlog:all=error:stderr"]
+    if os.path.exists(archive):
+        touch_artifact(archive)
+        return ["-XX:SharedArchiveFile=%s" % archive, *quiet], None
+    os.makedirs(folder, exist_ok=True)
+    # dump next to the archive and rename it when the jvm is done, parallel builds may dump at the same time
+    dump = "%s.%d-%d.tmp" % (archive, os.getpid(), threading.get_ident())
+    return ["-XX:ArchiveClassesAtExit=%s" % dump, *quiet], archive
+
+
+def run_cli(
+    args: list, capture: bool = True, cli_jar: str = "cli.jar", heap_size: int = None
+):
+    # only the command, the arguments can have keystore passwords
+    command = "cli %s%s" % (args[0], " --help" if "--help" in args else "")
+    with Span(command, "subprocess") as span:
+        # commands that need a heap size of their own can't share the daemon jvm
+        if USE_CLI_DAEMON and heap_size is None:
+            process = run_cli_in_daemon(args, capture, cli_jar)
+            if process is not None:
+                span.args.update(daemon=True, returncode=process.returncode)
+                return process
+
+        jvm_options, archive = cds_options(cli_jar)
+        heap_options = ["-Xmx%dm" % (heap_size // 1024 // 1024)] if heap_size else []
+        cmd = ["java", *jvm_options, *heap_options, "-jar", cli_jar, *args]
+        if capture:
+            process = subprocess.run(cmd, capture_output=True, text=True)
+        else:
+            process = subprocess.run(cmd)
+        span.args["returncode"] = process.returncode
+
+    if archive:
+        dump = jvm_options[0].split("=", 1)[1]
+        if process.returncode == 0 and os.path.exists(dump):
+            os.replace(dump, archive)
+            touch_artifact(archive)
+        elif os.path.exists(dump):
+            os.remove(dump)
+    return process
+
+
+CLI_DAEMON_LOCKS_LOCK = threading.Lock()
+CLI_DAEMON_LOCKS = {}
+
+
+def run_cli_in_daemon(args: list, capture: bool, cli_jar: str):
+    # relative paths in the arguments are resolved by the daemon, so there is one per cli.jar and folder
+    folder = os.path.join(CACHE_DIR, "daemon")
+    key = "%s-%s" % (
+        cached_file_digest(cli_jar)[:16],
+        hashlib.sha1(os.getcwd().encode()).hexdigest()[:8],
+    )
+    state_file = os.path.join(folder, key + ".json")
+    # pipeline tasks run cli commands at the same time, only one of them starts the daemon
+    with CLI_DAEMON_LOCKS_LOCK:
+        lock = CLI_DAEMON_LOCKS.setdefault(state_file, threading.Lock())
+
+    failed = None
+    for attempt in range(2):
+        with lock:
+            state = read_json(state_file)
+            # daemons from before the token can't be used, they stop on their own once they're idle.
+            # a daemon that failed us is replaced, unless another thread did that already
+            if (
+                state is None
+                or state == failed
+                or ("port" in state and "token" not in state)
+            ):
+                state = start_cli_daemon(cli_jar, folder, state_file)
+        if "port" not in state:
+            return None
+        try:
+            connection = socket.create_connection(
+                ("127.0.0.1", state["port"]), timeout=CLI_DAEMON_CONNECT_TIMEOUT
+            )
+        except OSError:
+            # the daemon timed out or got killed, start a new one
+            failed = state
+            continue
+
+        with connection:
+            connection.settimeout(CLI_DAEMON_READ_TIMEOUT)
+            request = [state["token"], str(len(args))] + list(args)
+            output = b""
+            try:
+                connection.sendall(("\n".join(request) + "\n").encode())
+                while True:
+                    chunk = connection.recv(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if not capture:
+                        # print everything up to the exit code marker as soon as it arrives
+                        shown = len(output)
+                        output += chunk
+                        visible = output.split(b"\0", 1)[0]
+                        sys.stdout.write(visible[shown:].decode(errors="replace"))
+                        sys.stdout.flush()
+                    else:
+                        output += chunk
+            except socket.timeout:
+                print("revanced-cli daemon stopped responding, stopping it")
+                stop_cli_daemon(state, state_file)
+                stdout = output.decode(errors="replace") if capture else None
+                return subprocess.CompletedProcess(args, 1, stdout, "")
+            except OSError:
+                pass
+        if output:
+            break
+        # not even an exit code: the token was refused (the port belongs to another daemon now)
+        # or the daemon died before the command printed anything
+        failed = state
+    else:
+        return None
+
+    output, _, code = output.partition(b"\0")
+    # no exit code means the daemon died during the command
+    returncode = int(code) if code else 1
+    stdout = output.decode(errors="replace") if capture else None
+    return subprocess.CompletedProcess(args, returncode, stdout, "")
+
+
+def stop_cli_daemon(state: dict, state_file: str):
+    try:
+        os.kill(state["pid"], signal.SIGTERM)
+    except OSError:
+        pass
+    if os.path.exists(state_file):
+        os.remove(state_file)
+
+
+def start_cli_daemon(cli_jar: str, folder: str, state_file: str) -> dict:
+    # only this user may read the tokens or change the source that java runs
+    os.makedirs(folder, mode=0o700, exist_ok=True)
+    os.chmod(folder, 0o700)
+    source_file = os.path.join(folder, "CliDaemon.java")
+    if read_text(source_file) != CLI_DAEMON_SOURCE:
+        with open(source_file, "w") as file:
+            file.write(CLI_DAEMON_SOURCE)
+
+    print("Starting revanced-cli daemon")
+    if os.name == "nt":
+        detach = {
+            "creationflags": subprocess.CREATE_NEW_PROCESS_GROUP
+            | subprocess.DETACHED_PROCESS
+        }
+    else:
+        # its own session, so ctrl+c in this terminal doesn't take the daemon down
+        detach = {"start_new_session": True}
+    try:
+        # java runs single source files directly since java 11
+        process = subprocess.Popen(
+            [
+                "java",
+                source_file,
+                os.path.abspath(cli_jar),
+                str(CLI_DAEMON_IDLE_TIMEOUT),
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            stdin=subprocess.DEVNULL,
+            text=True,
+            **detach,
+        )
+    except OSError as e:
+        print("Failed to start revanced-cli daemon:", e)
+        return {}
+    line = process.stdout.readline().strip()
+    process.stdout.close()
+
+    if line.startswith("PORT "):
+        port, token = line[5:].split()
+        state = {"port": int(port), "token": token, "pid": process.pid}
+    else:
+        # cli versions without the expected entry point are remembered so they aren't tried every run
+        print("revanced-cli daemon not available:", line or "failed to start")
+        state = {"unsupported": line}
+    write_json(state_file, state, private=True)
+    return state
+
+
+def read_text(path: str):
+    try:
+        with open(path) as file:
+            return file.read()
+    except OSError:
+        return None
+
+
+DIGESTS_FILE = os.path.join(CACHE_DIR, "digests.json")
+DIGESTS_LOCK = threading.Lock()
+
+
+def cached_file_digest(path: str) -> str:
+    # hashing is only repeated when the file changed, keyed by inode so hard links share the result
+    stat = os.stat(path)
+    key = "%d:%d" % (stat.st_dev, stat.st_ino)
+    with DIGESTS_LOCK:
+        digest = read_json(DIGESTS_FILE, {}).get(key)
+    if digest and digest[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return digest[2]
+    digest = file_digest(path)
+    remember_file_digest(path, digest)
+    return digest
+
+
+def remember_file_digest(path: str, digest: str):
+    stat = os.stat(path)
+    with DIGESTS_LOCK:
+        digests = read_json(DIGESTS_FILE, {})
+        digests["%d:%d" % (stat.st_dev, stat.st_ino)] = [
+            stat.st_size,
+            stat.st_mtime_ns,
+            digest,
+        ]
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        write_json(DIGESTS_FILE, digests)
+
+
+# list-patches and list-versions only depend on cli.jar and patches.rvp, their parsed output is kept
+# per pair of files so the jvm doesn't have to load the patch bundle again on the next run
+CATALOG_LOCK = threading.Lock()
+
+
+def catalog_file(cli_jar: str, patches_file: str) -> str:
+    return os.path.join(
+        CACHE_DIR,
+        "catalogs",
+        "%s-%s.json"
+        % (cached_file_digest(cli_jar)[:16], cached_file_digest(patches_file)[:16]),
+    )
+
+
+def update_catalog(path: str, key: str, value):
+    with CATALOG_LOCK:
+        catalog = read_json(path, {})
+        catalog[key] = value
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_json(path, catalog)
+
+
+def list_patches(
+    cli_jar: str = "cli.jar", patches_file: str = "patches.rvp"
+) -> "PatchCatalog":
+    catalog_path = catalog_file(cli_jar, patches_file)
+    rows = read_json(catalog_path, {}).get("patch_catalog")
+    if rows is not None:
+        return PatchCatalog.from_json(rows)
+
+    output = run_cli(["list-patches", patches_file, "-p"], cli_jar=cli_jar)
+    if output.returncode != 0:
+        sys.exit("Failed to list patches:\n%s" % (output.stderr or output.stdout))
+    catalog = PatchCatalog.parse(output.stdout)
+    update_catalog(catalog_path, "patch_catalog", catalog.to_json())
+    return catalog
+
+
+class Patch:
+    __slots__ = ("index", "name", "description", "enabled", "packages")
+
+    def __init__(
+        self,
+        index: int,
+        name: str,
+        description: str = "",
+        enabled: bool = True,
+        packages: tuple = (),
+    ):
+        self.index = index
+        self.name = name
+        self.description = description
+        self.enabled = enabled
+        # no packages means universal, it can be used on any app
+        self.packages = packages
+
+    def __repr__(self):
+        return "Patch(%d, %r)" % (self.index, self.name)
+
+
+class PatchCatalog:
+    # patch bundles of forks have hundreds of patches for dozens of apps, everything the script asks
+    # about them is answered from indexes built once instead of going through the whole list
+    __slots__ = (
+        "patches",
+        "by_package",
+        "by_name",
+        "universal",
+        "app_lists",
+    )
+
+    def __init__(self, patches: list):
+        self.patches = sorted(patches, key=lambda x: x.index)
+        self.by_package = {}
+        self.by_name = {}
+        self.universal = []
+        self.app_lists = {}
+        for patch in self.patches:
+            for package in patch.packages:
+                self.by_package.setdefault(package, []).append(patch)
+            if not patch.packages:
+                self.universal.append(patch)
+            # names aren't unique, forks have the same patch once per app
+            self.by_name.setdefault(patch.name.lower(), []).append(patch)
+
+    def __len__(self):
+        return len(self.patches)
+
+    def apps(self) -> list:
+        # in the order they first show up in the bundle, like before
+        return list(self.by_package)
+
+    def for_app(self, app: str) -> list:
+        # the patches of the app and the universal ones, in bundle order
+        if app not in self.app_lists:
+            self.app_lists[app] = sorted(
+                self.by_package.get(app, []) + self.universal, key=lambda x: x.index
+            )
+        return self.app_lists[app]
+
+    def named(self, name: str, app: str = None) -> list:
+        return [
+            patch
+            for patch in self.by_name.get(name.lower(), [])
+            if app is None or not patch.packages or app in patch.packages
+        ]
+
+    def to_json(self) -> list:
+        # one row per patch instead of a dict with repeated keys
+        return [
+            [x.index, x.name, x.description, x.enabled, list(x.packages)]
+            for x in self.patches
+        ]
+
+    @classmethod
+    def from_json(cls, rows: list) -> "PatchCatalog":
+        return cls(
+            [
+                Patch(index, name, description, enabled, tuple(packages))
+                for index, name, description, enabled, packages in rows
+            ]
+        )
+
+    @classmethod
+    def parse(cls, output: str) -> "PatchCatalog":
+        # list-patches -p prints blocks like
+        # Index: 0
+        # Name: Hide ads
+        # Description: ...
+        # Enabled: true
+        # Compatible packages:
+        # \tPackage name: com.google.android.youtube
+        # \tPackage name: ...
+        patches = []
+        # the first line comes through the cli's logger
+        output = output.strip()
+        if output.startswith("INFO: "):
+            output = output[len("INFO: ") :]
+        for block in output.split("\n\n"):
+            fields = {}
+            packages = []
+            for line in block.split("\n"):
+                key, _, value = line.partition(":")
+                key = key.strip().lower()
+                value = value.strip()
+                if key == "package name":
+                    packages.append(value)
+                elif key and key not in fields:
+                    fields[key] = value
+            if "index" not in fields:
+                continue
+            patches.append(
+                Patch(
+                    int(fields["index"]),
+                    fields.get("name", ""),
+                    (
+                        ""
+                        if fields.get("description") == "null"
+                        else fields.get("description", "")
+                    ),
+                    fields.get("enabled") != "false",
+                    tuple(packages),
+                )
+            )
+        return cls(patches)
+
+
+class SelectionError(ValueError):
+    # position is the offset in the selection the problem was found at, to point at it
+    def __init__(self, message: str, position: int):
+        super().__init__(message)
+        self.position = position
+
+    def show(self, selection: str) -> str:
+        return "%s\n%s\n%s^" % (self, selection, " " * self.position)
+
+
+class Selection:
+    # patch selections like "+4,-6-12", "e1,4,7-22,5" or "-spoof*,+/hide (ads|shorts)/" are parsed
+    # once into terms, turning them into cli flags is then a single pass over the terms.
+    # numbers are positions in the list that was shown, anything else is matched against the
+    # patch names: globs (a name without wildcards is the exact name) or /regex/, both ignore case
+    __slots__ = ("text", "exclusive", "terms")
+
+    SPACES = re.compile(r"\s*")
+    RANGE = re.compile(r"(\d+)(?:\s*-\s*(\d+))?\s*(?=,|$)")
+
+    def __init__(self, text: str):
+        self.text = text
+        self.exclusive = False
+        # (enable, matcher, position, source), matcher is a range (first, last and where they are)
+        # or the match function of a compiled pattern
+        self.terms = []
+        self.parse()
+
+    def parse(self):
+        text = self.text
+        position = 0
+        if text.startswith("e"):
+            self.exclusive = True
+            position = 1
+        while True:
+            position = self.SPACES.match(text, position).end()
+            if position == len(text) or text[position] == ",":
+                raise SelectionError("Missing a selection.", position)
+            enable = True
+            if text[position : position + 1] in ("+", "-"):
+                if self.exclusive:
+                    raise SelectionError(
+                        "You can't use + and - in exclusive selection!", position
+                    )
+                enable = text[position] == "+"
+                position = self.SPACES.match(text, position + 1).end()
+            elif not self.exclusive:
+                if text[position : position + 1] == "e":
+                    raise SelectionError(
+                        "e can only be at the beginning of the selection!", position
+                    )
+                raise SelectionError(
+                    "Prefix selections with + or - (or the whole selection with e).",
+                    position,
+                )
+            start = position
+            position, matcher = self.parse_item(position)
+            self.terms.append((enable, matcher, start, text[start:position].strip()))
+            position = self.SPACES.match(text, position).end()
+            if position == len(text):
+                return
+            if text[position] != ",":
+                raise SelectionError("Expected , between selections.", position)
+            position += 1
+
+    def parse_item(self, position: int) -> tuple:
+        text = self.text
+        if position == len(text) or text[position] == ",":
+            raise SelectionError("Missing a selection.", position)
+
+        if text[position] == "/":
+            end = position + 1
+            while end < len(text) and text[end] != "/":
+                # \/ is a slash inside the regex
+                end += 2 if text[end] == "\\" else 1
+            if end >= len(text):
+                raise SelectionError("The regex isn't closed with /.", position)
+            try:
+                pattern = re.compile(text[position + 1 : end], re.IGNORECASE)
+            except re.error as e:
+                raise SelectionError(
+                    "Invalid regex: %s." % e.msg, position + 1 + (e.pos or 0)
+                )
+            return end + 1, pattern.search
+
+        match = self.RANGE.match(text, position)
+        if match:
+            first = int(match.group(1))
+            last = int(match.group(2) or first)
+            if first == 0:
+                raise SelectionError("The list starts at 1 not 0!", match.start(1))
+            if last < first:
+                raise SelectionError(
+                    "The range has to go from low to high.", match.start(2)
+                )
+            return match.end(), (
+                first,
+                last,
+                match.start(1),
+                match.start(match.lastindex),
+            )
+
+        end = text.find(",", position)
+        end = len(text) if end == -1 else end
+        pattern = text[position:end].strip()
+        return end, re.compile(fnmatch.translate(pattern), re.IGNORECASE).match
+
+    def flags(self, patches: list) -> list:
+        # when terms overlap the last one decides, every patch is passed to the cli at most once
+        chosen = {}
+        for enable, matcher, position, source in self.terms:
+            if isinstance(matcher, tuple):
+                first, last, first_position, last_position = matcher
+                if first > len(patches):
+                    raise SelectionError(
+                        "%d is outside of the list index!" % first, first_position
+                    )
+                if last > len(patches):
+                    raise SelectionError(
+                        "%d is outside of the list index!" % last, last_position
+                    )
+                matched = patches[first - 1 : last]
+            else:
+                matched = [patch for patch in patches if matcher(patch.name)]
+                if not matched:
+                    raise SelectionError("No patch matches %s" % source, position)
+            for patch in matched:
+                chosen[patch.index] = enable
+        return (["--exclusive"] if self.exclusive else []) + [
+            ("--ei=%d" if enable else "--di=%d") % index
+            for index, enable in chosen.items()
+        ]
+
+
+def list_versions(
+    app: str, cli_jar: str = "cli.jar", patches_file: str = "patches.rvp"
+) -> list:
+    catalog_path = catalog_file(cli_jar, patches_file)
+    versions = read_json(catalog_path, {}).get("versions:%s" % app)
+    if versions is not None:
+        return versions
+
+    output = run_cli(["list-versions", patches_file, f"-f={app}"], cli_jar=cli_jar)
+    if output.returncode != 0:
+        sys.exit("Failed to list versions:\n%s" % (output.stderr or output.stdout))
+    versions = list(filter(lambda x: x.startswith("\t"), output.stdout.split("\n")))
+    versions = list(map(lambda x: x[1:], versions))
+    update_catalog(catalog_path, "versions:%s" % app, versions)
+    return versions
+
+
+def latest_supported_version(
+    app: str, cli_jar: str = "cli.jar", patches_file: str = "patches.rvp"
+) -> str:
+    versions = list_versions(app, cli_jar, patches_file)
+    # apps without compatible patches only get the universal ones, any version works
+    if not versions or len(versions) == 1 and versions[0] == "Any":
+        return ""
+    versions = [v.split(" ", 1)[0] for v in versions]
+    versions.sort(reverse=True)
+    print("Determined %s as latest supported version" % versions[0])
+    return versions[0]
+
+
+# results of jvm launches that only change when the java install or the keystore file changes
+PROBES_FILE = os.path.join(CACHE_DIR, "probes.json")
+PROBES_LOCK = threading.Lock()
+
+
+def cached_probe(key: str, probe):
+    with PROBES_LOCK:
+        probes = read_json(PROBES_FILE, {})
+    if key in probes:
+        return probes[key]
+    result = probe()
+    if result is not None:
+        with PROBES_LOCK:
+            probes = read_json(PROBES_FILE, {})
+            probes[key] = result
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            write_json(PROBES_FILE, probes)
+    return result
+
+
+def check_keystore_type(keystore_file: str, root: str):
+    print("Using keystore file:", os.path.abspath(keystore_file), end="")
+    if not os.path.exists(keystore_file):
+        # revanced-cli creates it, no need to ask keytool
+        type = "to_be_generated"
+        print(f"\t[{type}]")
+        return type
+
+    stat = os.stat(keystore_file)
+    key = "keystore:%s:%d:%d:%s" % (
+        os.path.abspath(keystore_file),
+        stat.st_size,
+        stat.st_mtime_ns,
+        file_digest(keystore_file),
+    )
+    cached = cached_probe(key, lambda: None)
+    if cached:
+        print(f"\t[{cached}]")
+        return cached
+    type = probe_keystore_type(keystore_file, root)
+    # unexpected results depend on the bouncycastle jar being around, check again next time
+    if type in ["old", "new"]:
+        cached_probe(key, lambda: type)
+    return type
+
+
+@traced("keytool", "subprocess")
+def probe_keystore_type(keystore_file: str, root: str):
+    # the bouncycastle jar is next to revanced.py, in root
+    command = [
+        "keytool",
+        "-list",
+        "-keystore",
+        keystore_file,
+        "-storetype",
+        "BKS",
+        "-provider",
+        "org.bouncycastle.jce.provider.BouncyCastleProvider",
+        "-providerpath",
+        os.path.join(root, "bcprov-jdk18on-176.jar"),
+        "-storepass",
+        "",
+    ]
+    process = subprocess.run(command, capture_output=True, text=True)
+
+    if (
+        process.returncode == 1
+        and "keytool error: java.lang.Exception: Keystore file does not exist:"
+        in process.stdout
+    ):
+        type = "to_be_generated"
+        print(f"\t[{type}]")
+        return type
+
+    if process.returncode == 0 and "Your keystore contains 1 entry" in process.stdout:
+        if "alias," in process.stdout:
+            type = "old"
+            print(f"\t[{type}]")
+            return type
+        if "ReVanced Key," in process.stdout:
+            type = "new"
+            print(f"\t[{type}]")
+            return type
+
+    if (
+        process.returncode == 1
+        and 'java.lang.Exception: Provider "org.bouncycastle.jce.provider.BouncyCastleProvider" not found'
+        in process.stdout
+    ):
+        print(
+            "\nKeycheck failed as BouncyCastle jar file is missing next to revanced.py"
+        )
+        return "unexpected"
+
+    print("Unexpected key, patching might fail")
+    return "unexpected"
+
+
+KEYSTORE_OPTIONS = {
+    "old": {
+        "--keystore-password": "ReVanced",
+        "--keystore-entry-alias": "alias",
+        "--keystore-entry-password": "ReVanced",
+    },
+    "new": {
+        "--keystore-password": "",
+        "--keystore-entry-alias": "ReVanced Key",
+        "--keystore-entry-password": "",
+    },
+}
+
+
+def keystore_options(keystore_type: str, custom: dict) -> list:
+    if keystore_type in KEYSTORE_OPTIONS.keys():
+        return [f"{key}={val}" for key, val in KEYSTORE_OPTIONS[keystore_type].items()]
+    # custom keys bring their own passwords and alias
+    return [f"--{key}={val}" for key, val in custom.items() if val is not None]
+
+
+def aapt2_options(root: str) -> list:
+    # the aapt2 binary bundled with revanced-cli doesn't run on android, termux needs one next to revanced.py
+    if "com.termux" not in sys.prefix:
+        return []
+    aapt2 = os.path.join(root, "aapt2")
+    if not os.path.exists(aapt2):
+        print("aapt2 file is missing, patching will probably fail")
+        return []
+    if not os.access(aapt2, os.X_OK):
+        subprocess.run(["chmod", "+x", aapt2], capture_output=True)
+        if not os.access(aapt2, os.X_OK):
+            print(
+                "aapt2 file is not executable and execute permission can't be added. Try cloning the repo somewhere inside termux "
+                "without using the /storage path."
+            )
+    return ["--custom-aapt2-binary=%s" % aapt2]
+
+
+# revanced-cli decodes the apk into a temporary files folder, by default next to the output file. every
+# package, version and cli gets a folder of its own in the cache instead, so builds of the same apk find
+# what an earlier build left there and builds of different apks can't get in each other's way
+CLI_TEMP_DIR = os.path.join(CACHE_DIR, "cli-tmp")
+STALE_LOCK_AGE = 6 * 60 * 60
+# written into locks next to the pid. a killed run's pid can come back (containers, termux), the token
+# tells this run's locks from those
+RUN_TOKEN = os.urandom(8).hex()
+
+
+def cli_patch_options(cli_jar: str) -> list:
+    def probe():
+        process = run_cli(["patch", "--help"], cli_jar=cli_jar)
+        return re.findall(r"--[\w-]+", process.stdout + (process.stderr or "")) or None
+
+    return cached_probe("patch-options:%s" % cached_file_digest(cli_jar), probe) or []
+
+
+def acquire_temporary_files(
+    cli_jar: str, package_name: str, version: str, apk_file: str
+):
+    # returns the folder and the lock file to give back to release_temporary_files, or None, None
+    # for clis that don't let us choose the folder
+    if "--temporary-files-path" not in cli_patch_options(cli_jar):
+        return None, None
+    folder = os.path.join(
+        CLI_TEMP_DIR,
+        "%s-%s-%s"
+        % (
+            package_name,
+            # apks without a known version are told apart by their content
+            version or cached_file_digest(apk_file)[:16],
+            cached_file_digest(cli_jar)[:16],
+        ),
+    )
+    lock_file = folder + ".lock"
+    os.makedirs(CLI_TEMP_DIR, exist_ok=True)
+    for attempt in range(2):
+        try:
+            descriptor = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if not lock_is_stale(lock_file):
+                break
+            # left behind by a run that got killed
+            try:
+                os.remove(lock_file)
+            except FileNotFoundError:
+                pass
+            continue
+        with os.fdopen(descriptor, "w") as file:
+            file.write("%d %s" % (os.getpid(), RUN_TOKEN))
+        touch_artifact(folder)
+        return folder, lock_file
+
+    # another build of the same apk is using the folder, this one gets a throwaway folder
+    folder = "%s.%d-%d" % (folder, os.getpid(), threading.get_ident())
+    return folder, None
+
+
+def release_temporary_files(folder: str, lock_file: str):
+    if folder is None:
+        return
+    if lock_file is None:
+        shutil.rmtree(folder, ignore_errors=True)
+    else:
+        touch_artifact(folder)
+        os.remove(lock_file)
+
+
+def lock_is_stale(lock_file: str) -> bool:
+    owner = (read_text(lock_file) or "").split()
+    if not owner or not owner[0].isdigit():
+        return True
+    pid = int(owner[0])
+    if pid == os.getpid():
+        # another thread of this run (batch builds of the same apk), or an earlier run with the same pid
+        return owner[1:] != [RUN_TOKEN]
+    if os.name == "nt":
+        # signal 0 would terminate the process on windows, go by the age of the lock there
+        return time.time() - os.path.getmtime(lock_file) > STALE_LOCK_AGE
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        # exists but belongs to another user
+        return False
+    return False
+
+
+# every build gets a manifest next to it with what went into it, the same inputs give the same apk so
+# patching again can be skipped. the keystore counts too, a different key means a different signature
+def build_inputs(
+    cli_jar: str,
+    patches_file: str,
+    apk_file: str,
+    keystore_file: str,
+    options: list,
+) -> dict:
+    files = {
+        "cli": cli_jar,
+        "patches": patches_file,
+        "apk": apk_file,
+        "keystore": keystore_file,
+    }
+    for option in options:
+        if option.startswith("--custom-aapt2-binary="):
+            files["aapt2"] = option.split("=", 1)[1]
+    return {
+        "files": {
+            name: cached_file_digest(path) if os.path.exists(path) else None
+            for name, path in files.items()
+        },
+        # --ei/--di selections, keystore options and the aapt2 override, in the order they are passed.
+        # passwords are left out, the keystore file and the alias already decide which key signs the build
+        "options": [
+            option
+            for option in options
+            if not option.startswith(
+                ("--keystore-password=", "--keystore-entry-password=")
+            )
+        ],
+    }
+
+
+def build_is_current(output_file: str, inputs: dict) -> bool:
+    manifest = read_json(output_file + ".json")
+    return (
+        manifest is not None
+        and manifest.get("inputs") == inputs
+        and os.path.exists(output_file)
+        and os.path.getsize(output_file) == manifest.get("size")
+    )
+
+
+def write_build_manifest(output_file: str, inputs: dict):
+    write_json(
+        output_file + ".json",
+        {
+            "inputs": inputs,
+            "size": os.path.getsize(output_file),
+            "built": time.time(),
+        },
+    )
+
+
+# cache management. everything the script downloads or builds is an artifact that can be evicted again,
+# least recently used first, once the cache grows past a size budget or gets too old
+USAGE_FILE = os.path.join(CACHE_DIR, "usage.json")
+PINS_FILE = os.path.join(CACHE_DIR, "pins.json")
+# files the script put into repository folders that aren't hard links into the asset store
+DOWNLOADS_FILE = os.path.join(CACHE_DIR, "downloads.json")
+BUILDS_DIR = os.path.join(os.path.dirname(CACHE_DIR), "_builds")
+USAGE_LOCK = threading.Lock()
+# artifacts of the build that is running right now
+PINNED = set()
+
+
+def touch_artifact(*paths: str):
+    with USAGE_LOCK:
+        usage = read_json(USAGE_FILE, {})
+        for path in paths:
+            usage[os.path.abspath(path)] = time.time()
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        write_json(USAGE_FILE, usage)
+
+
+def record_download(path: str):
+    # size and modification time tell a file we wrote from one the user put there in its place later
+    stat = os.stat(path)
+    with USAGE_LOCK:
+        downloads = read_json(DOWNLOADS_FILE, {})
+        downloads[os.path.abspath(path)] = [stat.st_size, stat.st_mtime_ns]
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        write_json(DOWNLOADS_FILE, downloads)
+
+
+def recorded_download(path: str, downloads: dict) -> bool:
+    stat = os.stat(path)
+    return downloads.get(os.path.abspath(path)) == [stat.st_size, stat.st_mtime_ns]
+
+
+def pin_artifact(*paths: str):
+    PINNED.update(os.path.abspath(path) for path in paths)
+
+
+def save_successful_build(*paths: str):
+    # the last successful build stays pinned until the next one replaces it
+    write_json(PINS_FILE, {"last_successful": [os.path.abspath(p) for p in paths]})
+
+
+def parse_size(size: str) -> int:
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*", size, flags=re.I)
+    if not match:
+        raise ValueError("invalid size %r, use something like 500M or 2G" % size)
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** " kmgt".index(unit.lower() or " "))
+
+
+def format_size(size: int) -> str:
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if size < 1024:
+            break
+        size /= 1024
+    return "%.1f %s" % (size, unit) if unit != "B" else "%d B" % size
+
+
+def cache_artifacts() -> list:
+    root = os.path.dirname(CACHE_DIR)
+    paths = []
+    for dirpath, _, files in os.walk(os.path.join(CACHE_DIR, "assets")):
+        paths += [os.path.join(dirpath, f) for f in files if f != "index.json"]
+    for dirpath, _, files in os.walk(os.path.join(CACHE_DIR, "cds")):
+        paths += [os.path.join(dirpath, f) for f in files if f.endswith(".jsa")]
+    for dirpath, _, files in os.walk(os.path.join(CACHE_DIR, "apks")):
+        paths += [
+            os.path.join(dirpath, f) for f in files if f.endswith((".apk", ".part"))
+        ]
+    if os.path.isdir(BUILDS_DIR):
+        paths += [
+            os.path.join(BUILDS_DIR, f)
+            for f in os.listdir(BUILDS_DIR)
+            if f.endswith(".apk")
+        ]
+    # repository folders are the ones that got revanced tools downloaded into them. files there can
+    # also be put by hand for --local, only hard links to stored assets, files the script recorded as
+    # its own downloads and partial downloads with their state sidecar are evicted
+    blobs = set()
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        blobs.add((stat.st_dev, stat.st_ino))
+    downloads = read_json(DOWNLOADS_FILE, {})
+    for folder in os.listdir(root):
+        folder = os.path.join(root, folder)
+        if not os.path.isdir(folder) or not any(
+            os.path.exists(os.path.join(folder, f)) for f in ["cli.jar", "patches.rvp"]
+        ):
+            continue
+        for f in os.listdir(folder):
+            path = os.path.join(folder, f)
+            try:
+                if f in ["cli.jar", "patches.rvp", "apk.apk"]:
+                    stat = os.stat(path)
+                    if (stat.st_dev, stat.st_ino) in blobs or recorded_download(
+                        path, downloads
+                    ):
+                        paths.append(path)
+                elif f.endswith(".part") and os.path.exists(path + ".json"):
+                    paths.append(path)
+            except OSError:
+                continue
+
+    # hard links share their data, group them so they are counted and deleted together
+    artifacts = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        artifact = artifacts.setdefault(
+            (stat.st_dev, stat.st_ino),
+            {"paths": [], "size": stat.st_size, "mtime": stat.st_mtime},
+        )
+        artifact["paths"].append(os.path.abspath(path))
+
+    # temporary files folders of revanced-cli go as a whole, locked ones are used by a running build.
+    # a lock left behind by a killed run doesn't count
+    folders = []
+    if os.path.isdir(CLI_TEMP_DIR):
+        for folder in os.listdir(CLI_TEMP_DIR):
+            folder = os.path.join(CLI_TEMP_DIR, folder)
+            lock_file = folder + ".lock"
+            if os.path.isdir(folder) and (
+                not os.path.exists(lock_file) or lock_is_stale(lock_file)
+            ):
+                folders.append(
+                    {
+                        "paths": [folder],
+                        "size": folder_size(folder),
+                        "mtime": os.path.getmtime(folder),
+                    }
+                )
+    return list(artifacts.values()) + folders
+
+
+def folder_size(folder: str) -> int:
+    size = 0
+    for dirpath, _, files in os.walk(folder):
+        for f in files:
+            try:
+                size += os.lstat(os.path.join(dirpath, f)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def collect_garbage(max_size: int = None, max_age: int = None, dry_run=False):
+    artifacts = cache_artifacts()
+    usage = read_json(USAGE_FILE, {})
+    pinned = PINNED | set(read_json(PINS_FILE, {}).get("last_successful", []))
+    for artifact in artifacts:
+        artifact["last_used"] = max(
+            [usage.get(path, 0) for path in artifact["paths"]] + [artifact["mtime"]]
+        )
+
+    total_size = sum(artifact["size"] for artifact in artifacts)
+    freed = 0
+    now = time.time()
+    print("Cache holds", format_size(total_size), "in %d files" % len(artifacts))
+    for artifact in sorted(artifacts, key=lambda x: x["last_used"]):
+        if pinned.intersection(artifact["paths"]):
+            continue
+        too_old = max_age is not None and now - artifact["last_used"] > max_age
+        too_big = max_size is not None and total_size - freed > max_size
+        if not too_old and not too_big:
+            # sorted from least recently used, everything after this is newer and fits
+            break
+        for path in artifact["paths"]:
+            print("Would remove" if dry_run else "Removing", path)
+            if not dry_run and os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+                # along with the stale lock of a killed run
+                if os.path.exists(path + ".lock"):
+                    os.remove(path + ".lock")
+            elif not dry_run:
+                # sidecars of partial downloads and stored apks go with their file
+                for leftover in [path, path + ".json", path + ".part.json"]:
+                    if os.path.exists(leftover):
+                        os.remove(leftover)
+        freed += artifact["size"]
+
+    if not dry_run:
+        with USAGE_LOCK:
+            usage = read_json(USAGE_FILE, {})
+            write_json(
+                USAGE_FILE, {k: v for k, v in usage.items() if os.path.exists(k)}
+            )
+            downloads = read_json(DOWNLOADS_FILE, {})
+            write_json(
+                DOWNLOADS_FILE,
+                {k: v for k, v in downloads.items() if os.path.exists(k)},
+            )
+    print(
+        "Would free" if dry_run else "Freed",
+        format_size(freed) + ",",
+        format_size(total_size - freed),
+        "left",
+    )
+
+
+def gc_main(argv: list):
+    parser = argparse.ArgumentParser(
+        prog="revanced.py gc",
+        description="remove least recently used tools, apks and builds from the cache",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--cache-size",
+        default=os.environ.get("REVANCED_CACHE_SIZE"),
+        help="size budget like 500M or 2G, also read from REVANCED_CACHE_SIZE",
+    )
+    parser.add_argument(
+        "--max-age",
+        type=float,
+        help="remove everything that wasn't used for this many days",
+    )
+    parser.add_argument(
+        "-n",
+        "--dry-run",
+        action="store_true",
+        help="only show what would be removed",
+    )
+    args = parser.parse_args(argv)
+    collect_garbage(
+        parse_size(args.cache_size) if args.cache_size else None,
+        args.max_age * 24 * 60 * 60 if args.max_age is not None else None,
+        args.dry_run,
+    )
+
+
+# main() runs as a graph of tasks, network and java work starts as soon as what it needs is known and
+# runs while the user answers prompts. prompts only ever happen on the main thread
+PIPELINE_WORKERS = 6
+
+
+class TaskOutput:
+    # stands in for sys.stdout while a graph runs. quiet tasks print into their own buffer that is
+    # shown when the main thread collects their result, instead of in the middle of a prompt.
+    # other tasks write whole lines so two tasks printing at once don't end up on one line
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def write(self, text: str):
+        output = getattr(CURRENT_TASK, "output", None)
+        if output is not None:
+            output.append(text)
+            return len(text)
+        line = getattr(CURRENT_TASK, "line", None)
+        if line is None:
+            return self.stream.write(text)
+        line.append(text)
+        if "\n" in text:
+            with self.lock:
+                self.stream.write("".join(line))
+            line.clear()
+        return len(text)
+
+    def flush(self):
+        if getattr(CURRENT_TASK, "output", None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class TaskGraph:
+    def __init__(self, max_workers: int = PIPELINE_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.cancel = threading.Event()
+        self.tasks = {}
+        self.outputs = {}
+
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = TaskOutput(self.stdout)
+        return self
+
+    def __exit__(self, *exc_info):
+        # whatever still runs isn't needed anymore, requests and downloads stop at their next chunk
+        self.cancel.set()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        sys.stdout = self.stdout
+
+    def add(self, name: str, function, *args, after: list = [], quiet: bool = False):
+        # function(*args) starts once every task in after has finished, a failed dependency fails the task too
+        future = Future()
+        self.tasks[name] = future
+        output = self.outputs[name] = [] if quiet else None
+        dependencies = [self.tasks[dependency] for dependency in after]
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            CURRENT_TASK.defer_prompts = True
+            CURRENT_TASK.cancel = self.cancel
+            CURRENT_TASK.output = output
+            CURRENT_TASK.line = []
+            try:
+                with Span(name, "task"):
+                    result = function(*args)
+                future.set_result(result)
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                CURRENT_TASK.defer_prompts = False
+                CURRENT_TASK.cancel = None
+                CURRENT_TASK.output = None
+                CURRENT_TASK.line = None
+                CURRENT_TASK.answers = None
+
+        waiting = [len(dependencies)]
+        lock = threading.Lock()
+
+        def start(_=None):
+            with lock:
+                waiting[0] -= 1
+                if waiting[0] > 0:
+                    return
+            failed = next(
+                (d for d in dependencies if d.cancelled() or d.exception()), None
+            )
+            if failed is not None:
+                if failed.cancelled():
+                    future.cancel()
+                elif future.set_running_or_notify_cancel():
+                    future.set_exception(failed.exception())
+                return
+            try:
+                self.executor.submit(run)
+            except RuntimeError:
+                # the graph was shut down while the dependencies finished
+                future.cancel()
+
+        if dependencies:
+            for dependency in dependencies:
+                dependency.add_done_callback(start)
+        else:
+            waiting[0] = 1
+            start()
+        return future
+
+    def result(self, name: str):
+        # waits for the task, shows what it printed and returns its result or raises its exception
+        future = self.tasks[name]
+        try:
+            return future.result()
+        finally:
+            output = self.outputs.get(name)
+            if output:
+                text = "".join(output)
+                output.clear()
+                print(text, end="")
+
+
+# batch builds. a manifest lists builds as combinations of revanced tools, app, version policy, patches and
+# keystore. releases, tools, patch lists and apks that builds have in common are only fetched once
+BATCH_BUILD_DEFAULTS = {
+    "name": None,
+    "repository": "revanced",
+    "cli": "revanced-cli",
+    "patches": "revanced-patches",
+    "package": None,
+    # latest supported by the patches, any, or a version number
+    "version": "latest",
+    "include": [],
+    "exclude": [],
+    "exclusive": False,
+    "apk_source": None,
+    # answers for the pickers of apkmirror, like --apkmirror-app and --variant
+    "apkmirror_app": None,
+    "variant": None,
+    "apk": None,
+    "keystore": None,
+    "keystore_password": None,
+    "keystore_entry_alias": None,
+    "keystore_entry_password": None,
+}
+
+
+# a patch job for youtube takes 1.5-3 GB of heap, running more of them than fit in memory makes the
+# machine swap or the kernel kill them. heap sizes are estimated from the apk size and jobs only start
+# when their heap fits next to the ones already running
+PATCH_HEAP_MIN = 1024 * 1024 * 1024
+PATCH_HEAP_MAX = 3 * 1024 * 1024 * 1024
+PATCH_HEAP_PER_APK_BYTE = 12
+# metaspace, thread stacks and the aapt2 processes the cli starts come on top of the heap
+PATCH_JVM_OVERHEAD = 256 * 1024 * 1024
+# left for the os and everything else that runs
+MEMORY_HEADROOM = 512 * 1024 * 1024
+
+
+def available_memory():
+    # MemAvailable counts reclaimable page cache too, MemFree would underestimate a lot
+    try:
+        with open("/proc/meminfo") as file:
+            for line in file:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def patch_heap_size(apk_file: str) -> int:
+    heap_size = os.path.getsize(apk_file) * PATCH_HEAP_PER_APK_BYTE
+    return max(PATCH_HEAP_MIN, min(PATCH_HEAP_MAX, heap_size))
+
+
+class PatchScheduler:
+    # jobs start in the order they asked, a job that doesn't fit yet holds up the ones behind it
+    # so big apps don't wait forever behind a stream of small ones
+    def __init__(self, max_jobs: int = None):
+        self.max_jobs = max_jobs or os.cpu_count() or 1
+        memory = available_memory()
+        # without /proc/meminfo (windows, macos) only the number of jobs is limited
+        self.budget = memory - MEMORY_HEADROOM if memory else None
+        self.condition = threading.Condition()
+        self.queue = []
+        self.running = 0
+        self.reserved = 0
+
+    def fit(self, heap_size: int) -> int:
+        # a job bigger than the whole budget runs alone with what there is
+        if self.budget is not None:
+            heap_size = min(heap_size, self.budget - PATCH_JVM_OVERHEAD)
+        return max(PATCH_HEAP_MIN, heap_size)
+
+    def admits(self, ticket, heap_size: int) -> bool:
+        if self.queue[0] is not ticket:
+            return False
+        if self.running == 0:
+            return True
+        if self.running >= self.max_jobs:
+            return False
+        return (
+            self.budget is None
+            or self.reserved + heap_size + PATCH_JVM_OVERHEAD <= self.budget
+        )
+
+    def acquire(self, heap_size: int) -> int:
+        heap_size = self.fit(heap_size)
+        ticket = object()
+        with self.condition:
+            self.queue.append(ticket)
+            while not self.admits(ticket, heap_size):
+                self.condition.wait()
+            self.queue.pop(0)
+            self.running += 1
+            self.reserved += heap_size + PATCH_JVM_OVERHEAD
+            # the next one in line might fit as well
+            self.condition.notify_all()
+        return heap_size
+
+    def release(self, heap_size: int):
+        with self.condition:
+            self.running -= 1
+            self.reserved -= heap_size + PATCH_JVM_OVERHEAD
+            self.condition.notify_all()
+
+
+class SharedResults:
+    # runs a function once per key, everyone else asking for the same key waits for that result
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.futures = {}
+
+    def get(self, key, function, *args, **kwargs):
+        with self.lock:
+            future = self.futures.get(key)
+            owner = future is None
+            if owner:
+                future = self.futures[key] = Future()
+        if owner:
+            try:
+                future.set_result(function(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+        return future.result()
+
+
+def read_manifest(path: str) -> dict:
+    with open(path, "rb") as file:
+        if path.endswith(".toml"):
+            if tomllib is None:
+                sys.exit(
+                    "TOML manifests need python 3.11 or newer, use a JSON manifest"
+                )
+            return tomllib.load(file)
+        return json.load(file)
+
+
+def batch_builds(manifest: dict, manifest_dir: str, root: str) -> list:
+    builds = []
+    for number, entry in enumerate(manifest.get("build", []), start=1):
+        build = dict(BATCH_BUILD_DEFAULTS)
+        build.update(manifest.get("defaults", {}))
+        build.update(entry)
+        unknown = set(build) - set(BATCH_BUILD_DEFAULTS)
+        if unknown:
+            sys.exit("build %d: unknown keys %s" % (number, ", ".join(sorted(unknown))))
+        if not build["package"]:
+            sys.exit("build %d: no package" % number)
+        if build["apk_source"] not in [None] + [x.__name__ for x in APK_SOURCES]:
+            sys.exit("build %d: unknown apk_source %s" % (number, build["apk_source"]))
+        for key in ["apkmirror_app", "variant"]:
+            if not isinstance(build[key], (str, type(None))):
+                sys.exit("build %d: %s must be a string" % (number, key))
+
+        # tools of forks mixed from different users get their own folder so they don't overwrite each other
+        if (build["cli"], build["patches"]) == ("revanced-cli", "revanced-patches"):
+            folder = build["repository"]
+        else:
+            folder = "+".join([build["repository"], build["cli"], build["patches"]])
+        build["folder"] = os.path.join(root, folder.replace("/", "_"))
+        build["name"] = (
+            build["name"]
+            or f'revanced({os.path.basename(build["folder"])})[{build["package"].replace(".", "_")}]'
+        )
+        if build["apk"]:
+            build["apk"] = os.path.join(manifest_dir, build["apk"])
+        if build["keystore"]:
+            build["keystore"] = os.path.join(manifest_dir, build["keystore"])
+        elif os.path.exists(os.path.join(root, "revanced.keystore")):
+            build["keystore"] = os.path.join(root, "revanced.keystore")
+        else:
+            build["keystore"] = os.path.join(build["folder"], "revanced.keystore")
+        builds.append(build)
+
+    names = [build["name"] for build in builds]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicates:
+        sys.exit("builds need different names: %s" % ", ".join(duplicates))
+    return builds
+
+
+def fetch_batch_tools(build: dict, connections: int):
+    os.makedirs(build["folder"], exist_ok=True)
+    releases = get_github_releases(
+        github_user=build["repository"],
+        cli_repo=build["cli"],
+        patches_repo=build["patches"],
+        get=["cli", "patches"],
+        latest=True,
+    )
+    cli_asset = next(
+        (
+            x
+            for x in releases["cli"][0]["assets"]
+            if x["content_type"] == "application/java-archive"
+        ),
+        None,
+    )
+    patches_asset = next(
+        (x for x in releases["patches"][0]["assets"] if x["name"].endswith(".rvp")),
+        None,
+    )
+    if cli_asset is None or patches_asset is None:
+        raise RuntimeError(
+            "no cli jar or .rvp patches in the latest releases of %s"
+            % os.path.basename(build["folder"])
+        )
+    cli_jar = os.path.join(build["folder"], "cli.jar")
+    patches_file = os.path.join(build["folder"], "patches.rvp")
+    fetch_release_asset(cli_asset, cli_jar, connections, False)
+    fetch_release_asset(patches_asset, patches_file, connections, False)
+    # fills the patch catalog every build of these tools reads from
+    list_patches(cli_jar, patches_file)
+    return cli_jar, patches_file
+
+
+def select_patches_by_name(catalog: PatchCatalog, build: dict) -> list:
+    selected = ["--exclusive"] if build["exclusive"] else []
+    for option, names in [("--ei", build["include"]), ("--di", build["exclude"])]:
+        for name in names:
+            matches = catalog.named(name, build["package"])
+            if not matches:
+                raise ValueError("no patch named %r for %s" % (name, build["package"]))
+            selected += ["%s=%s" % (option, x.index) for x in matches]
+    return selected
+
+
+def run_batch_build(build: dict, graph: TaskGraph, shared: dict, args):
+    build["started"] = time.time()
+    # nobody answers prompts in a batch, only the manifest does. the graph forgets them after the task
+    CURRENT_TASK.answers = {
+        key: build[key] for key in ["apkmirror_app", "variant"] if build[key]
+    }
+    cli_jar, patches_file = graph.result("tools:" + build["folder"])
+    package = build["package"]
+    selected_patches = select_patches_by_name(
+        list_patches(cli_jar, patches_file), build
+    )
+
+    if build["version"] == "latest":
+        version = shared["versions"].get(
+            (build["folder"], package),
+            latest_supported_version,
+            package,
+            cli_jar,
+            patches_file,
+        )
+    elif build["version"] == "any":
+        version = ""
+    else:
+        version = build["version"]
+    build["resolved_version"] = version
+
+    if build["apk"]:
+        apk_file = build["apk"]
+        if zip_problem(apk_file):
+            raise ValueError(
+                "%s is not a valid apk: %s" % (apk_file, zip_problem(apk_file))
+            )
+    else:
+        apk_sources = [
+            x for x in APK_SOURCES if build["apk_source"] in [None, x.__name__]
+        ]
+        apk_file = shared["apks"].get(
+            (package, version, build["apk_source"]),
+            fetch_apk,
+            package,
+            version,
+            apk_sources,
+            args.connections,
+            False,
+            # builds of one package from different sources download at the same time
+            os.path.join(
+                build["folder"],
+                ".".join(filter(None, [package, build["apk_source"], "apk"])),
+            ),
+        )
+
+    keystore_type = check_keystore_type(build["keystore"], os.path.dirname(CACHE_DIR))
+    custom_keystore = {
+        key: build[key.replace("-", "_")]
+        for key in [
+            "keystore-password",
+            "keystore-entry-alias",
+            "keystore-entry-password",
+        ]
+    }
+    output_file = os.path.join(build["folder"], build["name"] + ".apk")
+    patch_options = [
+        *selected_patches,
+        *keystore_options(keystore_type, custom_keystore),
+        *aapt2_options(os.path.dirname(CACHE_DIR)),
+    ]
+    command = [
+        "patch",
+        "-p=%s" % patches_file,
+        "--keystore=%s" % build["keystore"],
+        "--out=%s" % output_file,
+        apk_file,
+        *patch_options,
+    ]
+
+    build_file = os.path.join(BUILDS_DIR, build["name"] + ".apk")
+    inputs = build_inputs(
+        cli_jar, patches_file, apk_file, build["keystore"], patch_options
+    )
+    if not args.force and build_is_current(build_file, inputs):
+        print("Nothing changed since", build_file, "was built")
+        build["reused"] = True
+        touch_artifact(build_file)
+        return [cli_jar, patches_file, apk_file, build_file]
+
+    pin_artifact(cli_jar, patches_file, apk_file)
+    # the first build creates the keystore, the others sign with it afterwards. waiting for it happens
+    # before asking for memory so a waiting build doesn't hold memory another one could use
+    keystore_lock = (
+        shared["keystores"][build["keystore"]]
+        if keystore_type == "to_be_generated"
+        else threading.Lock()
+    )
+    with keystore_lock:
+        with Span("wait for memory"):
+            heap_size = shared["scheduler"].acquire(patch_heap_size(apk_file))
+        build["heap_size"] = heap_size
+        print("Patching with %s of heap" % format_size(heap_size))
+        temporary_files, temporary_files_lock = acquire_temporary_files(
+            cli_jar, package, version, apk_file
+        )
+        if temporary_files:
+            command.append("--temporary-files-path=%s" % temporary_files)
+        try:
+            process = run_cli(command, cli_jar=cli_jar, heap_size=heap_size)
+        finally:
+            shared["scheduler"].release(heap_size)
+            release_temporary_files(temporary_files, temporary_files_lock)
+    print(process.stdout, process.stderr, sep="\n")
+    if process.returncode != 0 or not os.path.exists(output_file):
+        raise RuntimeError("patching failed with exit code %d" % process.returncode)
+    output_file = os.path.abspath(shutil.move(output_file, build_file))
+    # like in run_pipeline, the next build sees a keystore generated by this one and passes its options
+    if keystore_type == "to_be_generated":
+        patch_options = [
+            *selected_patches,
+            *keystore_options(
+                check_keystore_type(build["keystore"], os.path.dirname(CACHE_DIR)),
+                custom_keystore,
+            ),
+            *aapt2_options(os.path.dirname(CACHE_DIR)),
+        ]
+    write_build_manifest(
+        output_file,
+        build_inputs(cli_jar, patches_file, apk_file, build["keystore"], patch_options),
+    )
+    touch_artifact(output_file)
+    return [cli_jar, patches_file, apk_file, output_file]
+
+
+def batch_main(argv: list):
+    parser = argparse.ArgumentParser(
+        prog="revanced.py batch",
+        description="build every app listed in a manifest without prompts",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        epilog=(
+            "the manifest (.json or .toml) has a list of builds under build and optional defaults for them. "
+            "build keys: %s" % ", ".join(BATCH_BUILD_DEFAULTS)
+        ),
+    )
+    parser.add_argument("manifest", help="path to the manifest file")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help=(
+            "most builds that patch at the same time (default: jobs from the manifest or the number of cpu cores). "
+            "builds only start patching when their java heap fits in the available memory"
+        ),
+    )
+    parser.add_argument(
+        "-c",
+        "--connections",
+        type=int,
+        default=4,
+        help="parallel connections used for downloads on servers that support byte ranges, 1 to disable",
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="patch every build again, even the ones with unchanged inputs",
+    )
+    parser.add_argument(
+        "--report",
+        default=os.path.join(BUILDS_DIR, "batch-report.json"),
+        help="where to write the json summary of all builds",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="run revanced-cli commands in a jvm that stays loaded in the background",
+    )
+    parser.add_argument(
+        "--no-cds",
+        action="store_true",
+        help="don't create or use class data sharing archives to speed up revanced-cli startup",
+    )
+    parser.add_argument(
+        "--cache-size",
+        default=os.environ.get("REVANCED_CACHE_SIZE"),
+        help="clean up least recently used tools, apks and builds after the batch once the cache is bigger than this",
+    )
+    parser.add_argument(
+        "--trace",
+        help="write chrome trace events of every build's phases, requests and java calls to this file",
+    )
+    args = parser.parse_args(argv)
+    global USE_CLI_DAEMON, USE_CDS, TRACE
+    USE_CLI_DAEMON = args.daemon
+    USE_CDS = not args.no_cds
+    if args.trace:
+        TRACE = Trace()
+
+    manifest = read_manifest(args.manifest)
+    root = os.path.dirname(CACHE_DIR)
+    builds = batch_builds(
+        manifest, os.path.dirname(os.path.abspath(args.manifest)), root
     )
-    headers = {
-        "User-Agent": USER_AGENT,
-    }
+    if not builds:
+        sys.exit("no builds in %s" % args.manifest)
+    scheduler = PatchScheduler(args.jobs or manifest.get("jobs"))
 
-    print("requesting", url)
-    r = Request(url=url, headers=headers)
     try:
-        response = urlopen(r)
-    except HTTPError as e:
-        if e.code == 404:
-            print("package not found")
-            raise e
-        else:
-            raise e
-
-    else:
-        if response.url.__contains__("/apk-downloader"):
-            msg = "version %s not found, likely too old" % version
-            print(msg)
-            raise RuntimeError(msg)
+        if java_info()["major"] < 11:
+            sys.exit(
+                "Incompatible java verson, revanced requires at least java 11\n%s"
+                % java_info()["version"]
+            )
+    except FileNotFoundError:
+        sys.exit("Java not found, install jdk11 or higher")
+    os.makedirs(BUILDS_DIR, exist_ok=True)
 
-        content = response.read()
-        response_headers = response.headers
-        encoding = response_headers.get_content_charset()
-        decoded = content.decode(encoding)
+    shared = {
+        "versions": SharedResults(),
+        "apks": SharedResults(),
+        "scheduler": scheduler,
+        "keystores": {build["keystore"]: threading.Lock() for build in builds},
+    }
+    toolsets = {build["folder"]: build for build in builds}
+    print(
+        "Building %d apps with %d sets of tools, up to %d at a time"
+        % (len(builds), len(toolsets), scheduler.max_jobs),
+        (
+            "within %s of memory" % format_size(scheduler.budget)
+            if scheduler.budget
+            else ""
+        ),
+    )
 
-        regex = r'https://d\.apkpure\.com/b/APK/.*?\?versionCode=\d+.*?(?=")'
-        url = re.search(regex, decoded)
-        if url == None:
-            msg = "did not find standalone apk"
-            print(msg)
-            raise RuntimeError(msg)
-        url = url.group()  # .replace("&amp;", "&")
+    report = []
+    successful = []
+    # every build waits in its own thread, only the patching itself is limited to jobs
+    with TaskGraph(max_workers=len(toolsets) + len(builds)) as graph:
+        for folder, build in toolsets.items():
+            graph.add(
+                "tools:" + folder,
+                fetch_batch_tools,
+                build,
+                args.connections,
+                quiet=True,
+            )
+        futures = {}
+        for build in builds:
+            future = graph.add(
+                "build:" + build["name"],
+                run_batch_build,
+                build,
+                graph,
+                shared,
+                args,
+                after=["tools:" + build["folder"]],
+                quiet=True,
+            )
+            futures[future] = build
 
-        class NoRedirectHandler(HTTPRedirectHandler):
-            def http_error_302(self, req, fp, code, msg, headers):
-                # raise Exception(f"Redirect detected: {headers.get('Location')}")
-                x = Exception("redirect detected")
-                x.location = headers.get("Location")
-                raise x
+        for future in as_completed(futures):
+            build = futures[future]
+            log_file = os.path.join(BUILDS_DIR, build["name"] + ".log")
+            with open(log_file, "w") as file:
+                file.write("".join(graph.outputs["build:" + build["name"]]))
+            error = future.exception()
+            entry = {
+                "name": build["name"],
+                "repository": build["repository"],
+                "cli": build["cli"],
+                "patches": build["patches"],
+                "package": build["package"],
+                "version": build.get("resolved_version"),
+                "heap_size": build.get("heap_size"),
+                "reused": build.get("reused", False),
+                "status": "failed" if error else "ok",
+                "seconds": round(time.time() - build.get("started", time.time()), 1),
+                "output": None if error else future.result()[-1],
+                "log": log_file,
+                "error": str(error) if error else None,
+            }
+            if not error:
+                successful += future.result()
+            report.append(entry)
+            print(
+                "%-6s %7.1fs  %s" % (entry["status"], entry["seconds"], entry["name"]),
+                "\t" + str(error) if error else "",
+            )
 
-        print("requesting", url)
-        opener = build_opener(NoRedirectHandler())
-        r = Request(url=url, headers=headers)
-        try:
-            with opener.open(r) as response:
-                pass
-        except Exception as e:
-            url = e.location
-            return url
+    write_json(args.report, report)
+    if successful:
+        save_successful_build(*successful)
+    failed = [entry for entry in report if entry["status"] != "ok"]
+    print(
+        "%d of %d builds succeeded, report written to %s"
+        % (len(report) - len(failed), len(report), args.report)
+    )
+    if args.cache_size:
+        collect_garbage(parse_size(args.cache_size))
+    if args.trace:
+        write_trace(args.trace)
+    if failed:
+        sys.exit(1)
 
 
-APK_SOURCES = [
-    apkcombo,
-    apkmirror,
-    apkpure,
-]
+def read_profile(path: str) -> dict:
+    try:
+        with open(path) as f:
+            profile = json.load(f)
+    except (OSError, ValueError) as e:
+        sys.exit("Can't read profile %s: %s" % (path, e))
+    if not isinstance(profile, dict):
+        sys.exit("Profile %s must be a json object of answers" % path)
+    unknown = [key for key in profile if key not in PROFILE_KEYS]
+    if unknown:
+        sys.exit(
+            "Unknown keys in profile %s: %s (known are %s)"
+            % (path, ", ".join(unknown), ", ".join(PROFILE_KEYS))
+        )
+    for key, value in profile.items():
+        # answers are compared as text. a whole number like a release is fine, a version written as a
+        # json number isn't, 19.10 would already have become 19.1
+        if isinstance(value, int) and not isinstance(value, bool):
+            profile[key] = str(value)
+        elif not isinstance(value, str):
+            sys.exit(
+                "Profile %s: %s must be a string in quotes, not %s"
+                % (path, key, json.dumps(value))
+            )
+    return profile
 
 
 def main():
+    if sys.argv[1:2] == ["gc"]:
+        return gc_main(sys.argv[2:])
+    if sys.argv[1:2] == ["batch"]:
+        return batch_main(sys.argv[2:])
+
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        epilog="run revanced.py gc -h to see how to clean up the cache and revanced.py batch -h for builds from a manifest",
     )
     parser.add_argument(
         "repository",
@@ -511,7 +3647,45 @@ def main():
         choices=[x.__name__ for x in APK_SOURCES] + ["local"],
         help=(
             "provide a local apk in the working directory or choose where to source apks from, "
-            "or let the script try all of them in random order until it succeeds"
+            "or let the script try all of them at once and use the first one that succeeds"
+        ),
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="patch again even if the last build with the same apk, tools, patches and key is still there",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help=(
+            "run revanced-cli commands in a jvm that stays loaded in the background between commands and runs, "
+            "falls back to starting java normally if that doesn't work"
+        ),
+    )
+    parser.add_argument(
+        "--no-cds",
+        action="store_true",
+        help="don't create or use class data sharing archives to speed up revanced-cli startup",
+    )
+    parser.add_argument(
+        "--cache-size",
+        default=os.environ.get("REVANCED_CACHE_SIZE"),
+        help="clean up least recently used tools, apks and builds after a build once the cache is bigger than this (e.g. 2G)",
+    )
+    parser.add_argument(
+        "-c",
+        "--connections",
+        type=int,
+        default=4,
+        help="parallel connections used for downloads on servers that support byte ranges, 1 to disable",
+    )
+    parser.add_argument(
+        "--trace",
+        help=(
+            "write how long every phase, task, request, download and java or keytool call took to this file "
+            "(chrome trace events, for chrome://tracing or ui.perfetto.dev) and print a summary at the end"
         ),
     )
     revanced_tools_args = parser.add_argument_group(
@@ -546,6 +3720,51 @@ def main():
         const="50",
     )
 
+    answer_args = parser.add_argument_group(
+        "answers",
+        description=(
+            "answers to what the script would ask, they can also come from a --profile file "
+            "(flags have priority). An answer picks the choice printed like it, or the only one containing it"
+        ),
+    )
+    answer_args.add_argument(
+        "--headless",
+        action="store_true",
+        help="never ask anything, stop when a question has no answer or more than one choice fits it",
+    )
+    answer_args.add_argument(
+        "--profile", help="json file with answers, the keys are the flag names below"
+    )
+    answer_args.add_argument(
+        "--save-profile",
+        help="write the answers of this run to a json file, to repeat it with --profile",
+    )
+    answer_args.add_argument(
+        "-a",
+        "--app",
+        help="package name of the app to patch, apps without patches get the universal ones",
+    )
+    answer_args.add_argument(
+        "--version",
+        help="apk version: latest (supported by the patches, default), any or a version number",
+    )
+    answer_args.add_argument(
+        "--select",
+        help="patch selection like at the prompt (e.g. --select=-spoof*,+hide*), empty for the defaults. selections starting with - need the = form",
+    )
+    answer_args.add_argument("--cli-release", help="name of the revanced-cli release")
+    answer_args.add_argument(
+        "--patches-release", help="name of the revanced-patches release"
+    )
+    answer_args.add_argument(
+        "--apkmirror-app",
+        help="apkmirror app page, for package names with more than one",
+    )
+    answer_args.add_argument(
+        "--variant", help="apkmirror variant (e.g. nodpi or universal)"
+    )
+    answer_args.add_argument("--apk", help="local apk file name with -s local")
+
     keystore_args = parser.add_argument_group(
         "keystore",
         description=(
@@ -572,299 +3791,196 @@ def main():
     )
 
     args = parser.parse_args()
+    global USE_CLI_DAEMON, USE_CDS, HEADLESS, TRACE
+    USE_CLI_DAEMON = args.daemon
+    USE_CDS = not args.no_cds
+    HEADLESS = args.headless
+    if args.trace:
+        TRACE = Trace()
+        args.trace = os.path.abspath(args.trace)
     # print(args)
+    if args.profile:
+        ANSWERS.update(read_profile(args.profile))
+    ANSWERS.update(
+        {
+            key: getattr(args, key)
+            for key in PROFILE_KEYS
+            if getattr(args, key) is not None
+        }
+    )
+    if args.save_profile:
+        # paths are relative to where the script was started, the build runs in the repository folder
+        args.save_profile = os.path.abspath(args.save_profile)
 
     for folder in ["_builds", args.repository]:
         if not os.path.exists(folder):
             os.makedirs(folder)
     os.chdir(args.repository)
 
-    cmd = ["java", "-version"]
+    keystore_file = (
+        args.keystore
+        if args.keystore
+        else (
+            "../revanced.keystore"
+            if os.path.exists(
+                os.path.join(os.path.dirname(os.getcwd()), "revanced.keystore")
+            )
+            else "revanced.keystore"
+        )
+    )
+
     try:
-        output = subprocess.check_output(cmd, stderr=subprocess.STDOUT, text=True)
-        first_line = output.split("\n")[0]
-        regex = r"^\w+ version \"?(\d{1,2})"
-        version = int(re.match(regex, first_line).group(1))
-        if version < 11:
-            print("Incompatible java verson, revanced requires at least java 11")
-            subprocess.run(cmd)  # show user's java version before exiting
-            sys.exit(1)
-    except FileNotFoundError:
-        sys.exit("Java not found, install jdk11 or higher")
+        with TaskGraph() as graph:
+            run_pipeline(args, graph, keystore_file)
+        if args.cache_size:
+            with Span("cache cleanup"):
+                collect_garbage(parse_size(args.cache_size))
+    except SelectionRequired as e:
+        # a question without a usable answer in headless mode, or an answer that doesn't fit
+        sys.exit(str(e))
+    finally:
+        # failed runs too, they are the ones worth looking at
+        if args.trace:
+            write_trace(args.trace)
+
+
+def run_pipeline(args, graph: TaskGraph, keystore_file: str):
+    # java and keytool only need local files, they run while the tools are downloaded
+    graph.add("java", java_info)
+    graph.add("keystore", check_keystore_type, keystore_file, "..", quiet=True)
 
     if not args.local:
-        cli = get_github_releases(
-            github_user=args.repository,
-            cli_repo=args.cli,
-            get=["cli"],
-            amount=args.select_cli if type(args.select_cli) == int else 1,
-            latest=not args.select_cli,
+        # both release lists are fetched at the same time, selecting a release happens on the main thread
+        graph.add(
+            "cli_releases",
+            functools.partial(
+                get_github_releases,
+                github_user=args.repository,
+                cli_repo=args.cli,
+                get=["cli"],
+                amount=(
+                    args.select_cli
+                    if type(args.select_cli) == int
+                    else 0 if "cli_release" in ANSWERS else 1
+                ),
+                latest=not args.select_cli and "cli_release" not in ANSWERS,
+            ),
+            quiet=True,
         )
-        cli = cli["cli"]
-        if args.select_cli == 0 or args.select_cli:
-            cli = select_one_item("Select cli version: ", cli, lambda x: x["name"])
-        else:
-            cli = cli[0]
-
-        patches = get_github_releases(
-            github_user=args.repository,
-            patches_repo=args.patches,
-            get=["patches"],
-            amount=args.select_patches if type(args.select_patches) == int else 1,
-            latest=not args.select_patches,
+        graph.add(
+            "patches_releases",
+            functools.partial(
+                get_github_releases,
+                github_user=args.repository,
+                patches_repo=args.patches,
+                get=["patches"],
+                amount=(
+                    args.select_patches
+                    if type(args.select_patches) == int
+                    else 0 if "patches_release" in ANSWERS else 1
+                ),
+                latest=not args.select_patches and "patches_release" not in ANSWERS,
+            ),
+            quiet=True,
         )
-        patches = patches["patches"]
-        if args.select_patches == 0 or args.select_cli:
-            patches = select_one_item(
-                "Select patches version: ", patches, lambda x: x["name"]
-            )
-        else:
-            patches = patches[0]
 
-        cli_url = next(
+        with Span("cli release"):
+            cli = graph.result("cli_releases")["cli"]
+            if args.select_cli == 0 or args.select_cli or "cli_release" in ANSWERS:
+                cli = select_one_item(
+                    "Select cli version: ",
+                    cli,
+                    lambda x: x["name"],
+                    answer_key="cli_release",
+                )
+            else:
+                cli = cli[0]
+        cli_asset = next(
             (
-                x["browser_download_url"]
+                x
                 for x in cli["assets"]
                 if x["content_type"] == "application/java-archive"
             ),
             None,
         )
-        download_file(cli_url, "cli.jar")
+        graph.add(
+            "cli", fetch_release_asset, cli_asset, "cli.jar", args.connections, False
+        )
 
-        try:
-            patches_url = next(
-                (
-                    x["browser_download_url"]
-                    for x in patches["assets"]
-                    if x["name"].endswith(".rvp")
-                ),
-                None,
-            )
-        except TypeError as e:
+        with Span("patches release"):
+            patches = graph.result("patches_releases")["patches"]
+            if (
+                args.select_patches == 0
+                or args.select_patches
+                or "patches_release" in ANSWERS
+            ):
+                patches = select_one_item(
+                    "Select patches version: ",
+                    patches,
+                    lambda x: x["name"],
+                    answer_key="patches_release",
+                )
+            else:
+                patches = patches[0]
+        patches_asset = next(
+            (x for x in patches["assets"] if x["name"].endswith(".rvp")),
+            None,
+        )
+        if patches_asset is None:
             print("failed to detect patches file")
             print(
                 "patches older than v5.0.0 (that use .jar extension) are not supported (yet?)"
             )
-            choice = select_one_item(
+            patches_asset = select_one_item(
                 "select patches manually: ", patches["assets"], lambda x: x["name"]
             )
-            patches_url = choice["browser_download_url"]
-        download_file(patches_url, "patches.rvp")
-
-    cmd = [
-        "java",
-        "-jar",
-        "cli.jar",
-        "list-patches",
-        "patches.rvp",
-        "-p",
-    ]
-    output = subprocess.run(
-        cmd,
-        capture_output=True,
-        text=True,
-    )
-    parsed_patches = output.stdout.strip().split("\n\n")
-    parsed_patches[0] = parsed_patches[0].replace("INFO: ", "", 1)
-    parsed_patches = [i.split("\n") for i in parsed_patches]
-    parsed_patches = list(
-        map(lambda x: [list(i.split(":", 1)) for i in x], parsed_patches)
-    )
-    for list_list in parsed_patches:
-        for _list in list_list:
-            _list[0] = _list[0].strip().replace(" ", "_").lower()
-            _list[1] = _list[1].strip()
-            if _list[1] == "true":
-                _list[1] = True
-            if _list[1] == "false":
-                _list[1] = False
-            if _list[1] == "null":
-                _list[1] = None
-            if _list[0] == "index":
-                _list[1] = int(_list[1])
-    parsed_patches = [dict(x) for x in parsed_patches]
-    for _dict in parsed_patches:
-        if "compatible_packages" in _dict.keys():
-            _dict["compatible_packages"] = _dict["package_name"]
-            del _dict["package_name"]
-
-    all_apps = []
-    for patch in parsed_patches:
-        if "compatible_packages" in patch.keys():
-            package = patch["compatible_packages"]
-            if package not in all_apps:
-                all_apps.append(package)
+        graph.add(
+            "patches",
+            fetch_release_asset,
+            patches_asset,
+            "patches.rvp",
+            args.connections,
+            False,
+        )
 
-    # print(all_apps)
-    app = select_one_item("Select app: ", all_apps)
-    print("Selected", app)
-    cmd = [
-        "java",
-        "-jar",
-        "cli.jar",
-        "list-versions",
-        "patches.rvp",
-        f"-f={app}",
-    ]
-    output = subprocess.run(
-        cmd,
-        capture_output=True,
-        text=True,
-    )
-    versions = list(filter(lambda x: x.startswith("\t"), output.stdout.split("\n")))
-    versions = list(map(lambda x: x[1:], versions))
-    if len(versions) == 1 and versions[0] == "Any":
-        version = ""
-    else:
-        versions = [v.split(" ", 1) for v in versions]
-        versions_patches_dict = dict(versions)
-        versions = [v[0] for v in versions]
-        versions.sort(reverse=True)
-        version = versions[0]
-        print("Determined %s as latest supported version" % version)
-
-    app_patches = []
-    for patch in parsed_patches:
-        # universal patch
-        if "compatible_packages" not in patch.keys():
-            app_patches.append(patch)
-            continue
-        if app in patch["compatible_packages"]:
-            app_patches.append(patch)
-    filter_function = lambda x: (
-        f'{x["name"]} - {x["description"]}'
-        if x["enabled"]
-        else f'(-) {x["name"]} - {x["description"]}'
-    )
+        with Span("tool downloads"):
+            graph.result("cli")
+            graph.result("patches")
 
-    def custom_parser(msg, allow_empty, item_list):
-        class CustomException(Exception):
-            def __init__(self, msg):
-                self.msg = msg
-                # print( 'custom exception occurred')
+    with Span("tool checks"):
+        try:
+            if graph.result("java")["major"] < 11:
+                print("Incompatible java verson, revanced requires at least java 11")
+                print(java_info()["version"])  # show user's java version before exiting
+                sys.exit(1)
+        except FileNotFoundError:
+            sys.exit("Java not found, install jdk11 or higher")
 
-        while True:
-            selection = input(msg)
-            msg = msg.split("\n")[-1]
-            try:
-                if selection == "" and allow_empty:
-                    # return [patch for patch in item_list if patch["enabled"]]
-                    return []
-                    # return None
-                if selection.startswith("e"):
-                    selection = selection[1:]
-                    if "e" in selection:
-                        raise CustomException(
-                            "You can only make one exclusive selection!"
-                        )
-                    t = ["--exclusive"]
-                    for part in selection.split(","):
-                        part.strip()
-                        if part.startswith("+") or part.startswith("-"):
-                            raise CustomException(
-                                "You can't use + and - in exclusive selection!"
-                            )
-                        if part.startswith("0"):
-                            raise CustomException("The list starts at 1 not 0!")
-                        if "-" in part:
-                            start, end = map(int, part.split("-"))
-                            if end > len(item_list):
-                                raise CustomException(
-                                    "%d is outside of the list index!" % end
-                                )
-                            # t += item_list[start - 1:end]
-                            t += ["--ei=%s" % i["index"] for i in item_list][
-                                start - 1 : end
-                            ]
-                        else:
-                            if int(part) > len(item_list):
-                                raise CustomException(
-                                    "%d is outside of the list index!" % int(part)
-                                )
-                            t.append(
-                                ["--ei=%s" % i["index"] for i in item_list][
-                                    int(part) - 1
-                                ]
-                            )
-                    return t
-                else:
-                    if "e" in selection:
-                        raise CustomException(
-                            "e can only be at the beginning of the selection!"
-                        )
-                    t = []
-                    for part in selection.split(","):
-                        part.strip()
-                        if part[0] not in ["+", "-"]:
-                            raise CustomException("Invalid selection.")
-                        if part.startswith("-"):
-                            part = part[1:]
-                            if part.startswith("0"):
-                                raise CustomException("The list starts at 1 not 0!")
-                            if "-" in part:
-                                start, end = map(int, part.split("-"))
-                                if end > len(item_list):
-                                    raise CustomException(
-                                        "%d is outside of the list index!" % end
-                                    )
-                                t += ["--di=%s" % i["index"] for i in item_list][
-                                    start - 1 : end
-                                ]
-                            else:
-                                if int(part) > len(item_list):
-                                    raise CustomException(
-                                        "%d is outside of the list index!" % int(part)
-                                    )
-                                t.append(
-                                    ["--di=%s" % i["index"] for i in item_list][
-                                        int(part) - 1
-                                    ]
-                                )
-                            # return t
-                        if part.startswith("+"):
-                            part = part[1:]
-                            if part.startswith("0"):
-                                raise CustomException("The list starts at 1 not 0!")
-                            if "-" in part:
-                                start, end = map(int, part.split("-"))
-                                if end > len(item_list):
-                                    raise CustomException(
-                                        "%d is outside of the list index!" % end
-                                    )
-                                t += ["--ei=%s" % i["index"] for i in item_list][
-                                    start - 1 : end
-                                ]
-                            else:
-                                if int(part) > len(item_list):
-                                    raise CustomException(
-                                        "%d is outside of the list index!" % int(part)
-                                    )
-                                t.append(
-                                    ["--ei=%s" % i["index"] for i in item_list][
-                                        int(part) - 1
-                                    ]
-                                )
-                            # return t
-                    return t
-            except CustomException as e:
-                print(e)
-            except Exception as e:
-                print(e)
-
-    selected_patches = select_multiple_items(
-        (
-            '"(-)" prefix means not used by default.\n'
-            "Select patches with id or range (e.g. 4,7-12,1).\n"
-            "Enable or disable selections by prefixing with + and - (e.g. +4,-6-12).\n"
-            "Make one exclusive selection by prefixing it with e (e.g. e1,4,7-22,5).\n"
-            "Enter selection or leave empty for default: "
-        ),
-        app_patches,
-        filter_function,
-        True,
-        custom_parser,
-    )
-    # print(selected_patches)
+        # a broken file is cheaper to find here than by a jvm failing on it
+        for path in ["cli.jar", "patches.rvp"]:
+            problem = zip_problem(path) if os.path.exists(path) else "missing"
+            if problem:
+                sys.exit(
+                    "%s is broken (%s), run without --local to download it again"
+                    % (path, problem)
+                )
+
+    # the cli is asked once what its patch command supports, while patches are selected
+    graph.add("patch_options", cli_patch_options, "cli.jar", quiet=True)
+    with Span("list patches"):
+        catalog = list_patches()
+
+    all_apps = catalog.apps()
+
+    # print(all_apps)
+    with Span("app"):
+        app = ANSWERS.get("app")
+        if app is not None and not any(app.lower() in x.lower() for x in all_apps):
+            print("No patches for %s besides the universal ones" % app)
+        else:
+            app = select_one_item("Select app: ", all_apps, answer_key="app")
+    ANSWERS["app"] = app
+    print("Selected", app)
 
     if not args.apk_source == "local":
         apk_sources = (
@@ -872,156 +3988,189 @@ def main():
             if args.apk_source
             else APK_SOURCES
         )
-        shuffle(apk_sources)
-        apk_url = None
-        while apk_url == None and len(apk_sources):
-            try:
-                apk_url = apk_sources.pop()(package_name=app, version=version)
-            except Exception as e:
-                tb = traceback.format_exc()
-                print("\tfailed", e, "\n", tb, "\n")
-        assert apk_url, "Failed to scrape apk url."
-        download_file(apk_url, "apk.apk")
-        apk_file = "apk.apk"
-    else:
-        files = os.listdir(os.path.dirname(os.getcwd()))
-        apk_files = [file for file in files if file.endswith(".apk")]
-        if len(apk_files):
-            apk_file = "../" + select_one_item(
-                "Select local apk: ",
-                apk_files,
-            )
+        # scraping and downloading the apk only needs the app, it runs while patches are selected
+        version = ANSWERS.get("version", "latest")
+        if version == "latest":
+            graph.add("version", latest_supported_version, app, quiet=True)
         else:
-            print(
-                "No apk files found in the working directory, place them next to revanced.py"
-            )
-            sys.exit(1)
-
-    keystore_file = (
-        args.keystore
-        if args.keystore
-        else (
-            "../revanced.keystore"
-            if os.path.exists(
-                os.path.join(os.path.dirname(os.getcwd()), "revanced.keystore")
-            )
-            else "revanced.keystore"
+            graph.add("version", lambda: "" if version == "any" else version)
+        graph.add(
+            "apk",
+            lambda: fetch_apk(
+                app, graph.result("version"), apk_sources, args.connections, False
+            ),
+            after=["version"],
+            quiet=True,
         )
+
+    app_patches = catalog.for_app(app)
+    filter_function = lambda x: (
+        f"{x.name} - {x.description}"
+        if x.enabled
+        else f"(-) {x.name} - {x.description}"
     )
-    output_file = f'revanced({args.repository})[{app.replace(".", "_")}].apk'
 
-    def check_keystore_type(keystore_file: str):
-        print("Using keystore file:", os.path.abspath(keystore_file), end="")
-        command = [
-            "keytool",
-            "-list",
-            "-keystore",
-            keystore_file,
-            "-storetype",
-            "BKS",
-            "-provider",
-            "org.bouncycastle.jce.provider.BouncyCastleProvider",
-            "-providerpath",
-            "../bcprov-jdk18on-176.jar",
-            "-storepass",
-            "",
-        ]
-        process = subprocess.run(command, capture_output=True, text=True)
+    def custom_parser(msg, allow_empty, item_list):
+        while True:
+            selection = input(msg)
+            msg = msg.split("\n")[-1]
+            if selection.strip() == "" and allow_empty:
+                # the patches that are enabled by default
+                ANSWERS["select"] = ""
+                return []
+            try:
+                flags = Selection(selection).flags(item_list)
+                ANSWERS["select"] = selection
+                return flags
+            except SelectionError as e:
+                print(e.show(selection))
 
-        if (
-            process.returncode == 1
-            and "keytool error: java.lang.Exception: Keystore file does not exist:"
-            in process.stdout
-        ):
-            type = "to_be_generated"
-            print(f"\t[{type}]")
-            return type
+    with Span("patch selection"):
+        selection = ANSWERS.get("select", "" if HEADLESS else None)
+        if selection is not None:
+            try:
+                selected_patches = (
+                    Selection(selection).flags(app_patches) if selection.strip() else []
+                )
+            except SelectionError as e:
+                sys.exit(e.show(selection))
+        else:
+            selected_patches = select_multiple_items(
+                (
+                    '"(-)" prefix means not used by default.\n'
+                    "Select patches with id, range, name, glob or /regex/ (e.g. 4,7-12,hide*,/ads$/).\n"
+                    "Enable or disable selections by prefixing with + and - (e.g. +4,-6-12,-spoof*).\n"
+                    "Make one exclusive selection by prefixing it with e (e.g. e1,4,7-22,5).\n"
+                    "Enter selection or leave empty for default: "
+                ),
+                app_patches,
+                filter_function,
+                True,
+                custom_parser,
+            )
+    # print(selected_patches)
 
-        if (
-            process.returncode == 0
-            and "Your keystore contains 1 entry" in process.stdout
-        ):
-            if "alias," in process.stdout:
-                type = "old"
-                print(f"\t[{type}]")
-                return type
-            if "ReVanced Key," in process.stdout:
-                type = "new"
-                print(f"\t[{type}]")
-                return type
+    with Span("apk"):
+        if not args.apk_source == "local":
+            if not graph.tasks["apk"].done():
+                print("Waiting for the apk download")
+            try:
+                apk_file = graph.result("apk")
+            except SelectionRequired as e:
+                if HEADLESS:
+                    raise
+                # a source needs the user to pick something, only the deferred sources run again where
+                # prompts work
+                apk_file = fetch_apk(
+                    app,
+                    graph.result("version"),
+                    apk_sources,
+                    args.connections,
+                    deferred_sources=getattr(e, "deferred", None),
+                )
+        else:
+            files = os.listdir(os.path.dirname(os.getcwd()))
+            apk_files = [file for file in files if file.endswith(".apk")]
+            if len(apk_files):
+                apk_file = "../" + select_one_item(
+                    "Select local apk: ", apk_files, answer_key="apk"
+                )
+                if zip_problem(apk_file):
+                    sys.exit(
+                        "%s is not a valid apk: %s" % (apk_file, zip_problem(apk_file))
+                    )
+            else:
+                print(
+                    "No apk files found in the working directory, place them next to revanced.py"
+                )
+                sys.exit(1)
 
-        if (
-            process.returncode == 1
-            and 'java.lang.Exception: Provider "org.bouncycastle.jce.provider.BouncyCastleProvider" not found'
-            in process.stdout
-        ):
-            print(
-                "\nKeycheck failed as BouncyCastle jar file is missing from the working directory"
-            )
-            return "unexpected"
+    if args.save_profile:
+        write_json(
+            args.save_profile,
+            {key: ANSWERS[key] for key in PROFILE_KEYS if key in ANSWERS},
+        )
+        print("Answers saved to", args.save_profile)
 
-        print("Unexpected key, patching might fail")
-        return "unexpected"
+    output_file = f'revanced({args.repository})[{app.replace(".", "_")}].apk'
 
-    keystore_options_map = {
-        "old": {
-            "--keystore-password": "ReVanced",
-            "--keystore-entry-alias": "alias",
-            "--keystore-entry-password": "ReVanced",
-        },
-        "new": {
-            "--keystore-password": "",
-            "--keystore-entry-alias": "ReVanced Key",
-            "--keystore-entry-password": "",
-        },
-    }
-    keystore_type = check_keystore_type(keystore_file)
-    keystore_options = []
-    if keystore_type in keystore_options_map.keys():
-        for key, val in keystore_options_map[keystore_type].items():
-            keystore_options.append(f"{key}={val}")
-    else:
+    with Span("keystore check"):
+        keystore_type = graph.result("keystore")
+    custom_keystore = {
+        key: getattr(args, key.replace("-", "_"))
         for key in [
             "keystore-password",
             "keystore-entry-alias",
             "keystore-entry-password",
-        ]:
-            if key in args:
-                keystore_options.append(f"--{key}={args.key}")
-
+        ]
+    }
+    patch_options = [
+        *selected_patches,
+        *keystore_options(keystore_type, custom_keystore),
+        *aapt2_options(".."),
+    ]
     build_command = [
-        "java",
-        "-jar",
-        "cli.jar",
         "patch",
         "-p=patches.rvp",
-        *selected_patches,
         "--keystore=%s" % keystore_file,
-        *keystore_options,
         "--out=%s" % output_file,
         # "apk.apk",
         apk_file,
+        *patch_options,
     ]
 
-    if "com.termux" in sys.prefix:
-        if os.path.exists("../aapt2"):
-            build_command.append("--custom-aapt2-binary=../aapt2")
-            if not os.access("../aapt2", os.X_OK):
-                subprocess.run(["chmod", "+x", "../aapt2"], capture_output=True)
-                if not os.access("../aapt2", os.X_OK):
-                    print(
-                        "aapt2 file is not executable and execute permission can't be added. Try cloning the repo somewhere inside termux "
-                        "without using the /storage path."
-                    )
-        else:
-            print("aapt2 file is missing, patching will probably fail")
+    build_file = os.path.abspath("../_builds/" + output_file)
+    with Span("previous build"):
+        inputs = build_inputs(
+            "cli.jar", "patches.rvp", apk_file, keystore_file, patch_options
+        )
+        if not args.force and build_is_current(build_file, inputs):
+            print(
+                "Nothing changed since",
+                build_file,
+                "was built, use --force to build it again",
+            )
+            touch_artifact(build_file)
+            save_successful_build("cli.jar", "patches.rvp", apk_file, build_file)
+            return
 
-    # print(build_command)
-    subprocess.run(build_command)
-    print(
-        "Moved to",
-        os.path.abspath(shutil.move(output_file, "../_builds/" + output_file)),
+    with Span("patch"):
+        graph.result("patch_options")
+        temporary_files, temporary_files_lock = acquire_temporary_files(
+            "cli.jar",
+            app,
+            graph.result("version") if "version" in graph.tasks else "",
+            apk_file,
+        )
+        if temporary_files:
+            build_command.append("--temporary-files-path=%s" % temporary_files)
+
+        # print(build_command)
+        pin_artifact("cli.jar", "patches.rvp", apk_file)
+        try:
+            process = run_cli(build_command, capture=False)
+        finally:
+            release_temporary_files(temporary_files, temporary_files_lock)
+    if process.returncode != 0 or not os.path.exists(output_file):
+        sys.exit("Patching failed")
+    output_file = os.path.abspath(shutil.move(output_file, "../_builds/" + output_file))
+    print("Moved to", output_file)
+    # a keystore generated by this build is part of the inputs from now on, with the options the next run
+    # passes for it
+    if keystore_type == "to_be_generated":
+        patch_options = [
+            *selected_patches,
+            *keystore_options(
+                check_keystore_type(keystore_file, ".."), custom_keystore
+            ),
+            *aapt2_options(".."),
+        ]
+    write_build_manifest(
+        output_file,
+        build_inputs("cli.jar", "patches.rvp", apk_file, keystore_file, patch_options),
     )
+    touch_artifact(output_file)
+    save_successful_build("cli.jar", "patches.rvp", apk_file, output_file)
 
 
 if __name__ == "__main__":